@@ -0,0 +1,334 @@
+#!/usr/bin/env python3
+
+# Benchmarks the full poll, merge and publish pipeline of sunpower_mqtt.py against the simulators in simulator.py.
+# Each scenario starts the simulators in a child process (so their work does not count against the pipeline),
+# loads a fresh copy of sunpower_mqtt with a generated config pointing at them and then runs pvs_sample,
+# ess_sample and mqtt_publish back to back. Reported per scenario:
+#   latency   wall time of a cycle (poll, merge, publish and the broker acknowledging every message) in ms
+#   pvs/ess/publish   the median wall time of each stage in ms
+#   cpu       process CPU time per cycle in ms (includes the MQTT and Modbus threads)
+#   alloc     peak and retained traced memory per cycle in KiB, measured in separate cycles under tracemalloc
+#   msgs      messages published per cycle and per second of cycle time
+# Results can be saved with --save and compared with --baseline, the exit status is 1 when a metric regressed by
+# more than --tolerance.
+# --startup instead measures how quickly the application starts: the time to import sunpower_mqtt in a fresh
+# interpreter and the time from starting run.sh's command (python -m sunpower_mqtt) to the first device data arriving
+# at the simulated MQTT server, once with the ESS host configured and once while the ESS is still being searched
+# for. The exit status is 1 when the import takes longer than --import-budget or the first publish longer than
+# --startup-budget. The default budgets are about 2.5 times the times measured on a development machine (about
+# 100 ms to import and 370 ms to the first publish).
+
+import argparse
+import asyncio
+import configparser
+import importlib
+import json
+import multiprocessing
+import os
+import py_compile
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.abspath(os.path.dirname(__file__)))
+
+SCRIPT_DIR = os.path.abspath(os.path.dirname(__file__))
+TEMPLATE_PATH = os.path.join(SCRIPT_DIR, "config_template.ini")
+REGRESSION_METRICS = ("latency_p50", "latency_p95", "cpu", "alloc_peak", "alloc_retained")
+
+
+# Writes a config based on the template with every remote pointing at the simulators.
+def write_config(path, ports, batteries):
+    config = configparser.ConfigParser()
+    config.optionxform = str
+    config.read(TEMPLATE_PATH)
+    config["pvs"]["host"] = f"127.0.0.1:{ports['pvs']}"
+    config["ess"]["enabled"] = str(batteries > 0)
+    config["ess"]["host"] = "127.0.0.1"
+    config["ess"]["port"] = str(ports["ess"])
+    config["ess"]["battery_count"] = str(max(batteries, 1))
+    config["ess"]["timeout"] = "5"
+    config["mqtt"]["enabled"] = "True"
+    config["mqtt"]["host"] = "127.0.0.1"
+    config["mqtt"]["port"] = str(ports["mqtt"])
+    config["metrics"]["enabled"] = "False"
+    config["buffer"]["path"] = f"buffer_{ports['mqtt']}.bin"
+    with open(path, "w") as file:
+        config.write(file)
+
+
+# Imports a fresh copy of sunpower_mqtt so no state leaks from one scenario into the next.
+def load_sunpower_mqtt(config_path):
+    os.environ["SUNPOWER_MQTT_CONFIG"] = config_path
+    sys.modules.pop("sunpower_mqtt", None)
+    return importlib.import_module("sunpower_mqtt")
+
+
+# Child process running the simulators. Sends the ports once listening, then answers "stats" until "stop".
+def simulator_process(connection, inverters, meters, batteries):
+    from simulator import EssSimulator, MqttSink, PvsSimulator
+    from sunpower_mqtt import ESS_REGISTERS
+
+    async def run():
+        pvs = PvsSimulator(inverters, meters, batteries, seed=1)
+        ess = EssSimulator(ESS_REGISTERS, batteries, seed=1)
+        sink = MqttSink()
+        for simulator in (pvs, ess, sink):
+            await simulator.start()
+        connection.send({ "pvs": pvs.port, "ess": ess.port, "mqtt": sink.port })
+        loop = asyncio.get_running_loop()
+        while True:
+            command = await loop.run_in_executor(None, connection.recv)
+            if command == "stop":
+                break
+            first_data_times = [first_time for topic, first_time in sink.first_times.items() if topic.endswith("/data")]
+            connection.send({ "pvs_requests": pvs.requests, "ess_requests": ess.requests, "mqtt_messages": sink.messages, "mqtt_bytes": sink.bytes,
+                              "first_data_time": min(first_data_times) if len(first_data_times) > 0 else None })
+        for simulator in (pvs, ess, sink):
+            await simulator.stop()
+
+    asyncio.run(run())
+
+
+def published(module):
+    return module.METRICS.counters.get(("sunpower_mqtt_messages_total", ()), 0)
+
+
+async def cycle(module):
+    site = module.SITES[0]
+    times = {}
+    start = time.perf_counter()
+    await module.pvs_sample(site)
+    times["pvs"] = time.perf_counter()
+    if site.ess_enabled:
+        await module.ess_sample(site)
+    times["ess"] = time.perf_counter()
+    await module.mqtt_publish()
+    while len(module.MQTT_PUBLISHER.inflight) > 0:
+        await asyncio.sleep(0.0005)
+    times["publish"] = time.perf_counter()
+    return { "latency": times["publish"] - start, "pvs": times["pvs"] - start, "ess": times["ess"] - times["pvs"], "publish": times["publish"] - times["ess"] }
+
+
+async def run_pipeline(module, cycles, allocation_cycles):
+    if module.BUFFER_ENABLED:
+        module.MQTT_BUFFER = module.MessageBuffer(module.BUFFER_PATH, module.BUFFER_SIZE)
+    # The first cycle creates the sessions and starts the MQTT client, nothing is published until it connects.
+    await cycle(module)
+    for _ in range(1000):
+        if module.MQTT_PUBLISHER.connected:
+            break
+        await asyncio.sleep(0.01)
+    else:
+        raise ConnectionError("MQTT sink did not accept the connection")
+    # Whatever was published before the connection came up was stored in the buffer, deliver it first.
+    while module.MQTT_BUFFER is not None and module.MQTT_BUFFER.count > 0:
+        await module.mqtt_drain_buffer()
+    # Resynchronise as after a reconnect so the measured first cycle sends the Home Assistant config for every device.
+    module.MQTT_PUBLISHER.resync = True
+    before = published(module)
+    first = await cycle(module)
+    first["messages"] = published(module) - before
+
+    samples = []
+    before = published(module)
+    cpu_start = time.process_time()
+    for _ in range(cycles):
+        samples.append(await cycle(module))
+    cpu = (time.process_time() - cpu_start) / cycles
+    messages = published(module) - before
+
+    peaks = []
+    retained = []
+    tracemalloc.start()
+    for _ in range(allocation_cycles):
+        tracemalloc.reset_peak()
+        current = tracemalloc.get_traced_memory()[0]
+        await cycle(module)
+        after, peak = tracemalloc.get_traced_memory()
+        peaks.append(peak - current)
+        retained.append(after - current)
+    tracemalloc.stop()
+
+    module.MQTT_PUBLISHER.stop()
+    await module.SITES[0].pvs_session.close()
+    if module.SITES[0].ess_modbus is not None:
+        module.SITES[0].ess_modbus.close()
+
+    latencies = sorted(sample["latency"] for sample in samples)
+    total_time = sum(latencies)
+    return {
+        "first_latency": first["latency"] * 1000,
+        "first_messages": first["messages"],
+        "latency_p50": statistics.median(latencies) * 1000,
+        "latency_p95": latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] * 1000,
+        "latency_max": latencies[-1] * 1000,
+        "pvs": statistics.median(sample["pvs"] for sample in samples) * 1000,
+        "ess": statistics.median(sample["ess"] for sample in samples) * 1000,
+        "publish": statistics.median(sample["publish"] for sample in samples) * 1000,
+        "cpu": cpu * 1000,
+        "alloc_peak": statistics.median(peaks) / 1024 if peaks else 0,
+        "alloc_retained": statistics.median(retained) / 1024 if retained else 0,
+        "messages": messages / cycles,
+        "messages_per_second": messages / total_time if total_time > 0 else 0,
+    }
+
+
+def run_scenario(directory, inverters, meters, batteries, cycles, allocation_cycles):
+    connection, child_connection = multiprocessing.Pipe()
+    process = multiprocessing.Process(target=simulator_process, args=(child_connection, inverters, meters, batteries), daemon=True)
+    process.start()
+    try:
+        ports = connection.recv()
+        config_path = os.path.join(directory, f"config_{inverters}_{batteries}.ini")
+        write_config(config_path, ports, batteries)
+        module = load_sunpower_mqtt(config_path)
+        result = asyncio.run(run_pipeline(module, cycles, allocation_cycles))
+        connection.send("stats")
+        result.update(connection.recv())
+        connection.send("stop")
+    finally:
+        process.join(5)
+        if process.is_alive():
+            process.terminate()
+    result.update({ "inverters": inverters, "meters": meters, "batteries": batteries, "devices": 1 + inverters + meters + (6 + 2 * batteries if batteries > 0 else 0) })
+    return result
+
+
+# Median time to import sunpower_mqtt in a fresh interpreter, in ms. The module is compiled first so the cached
+# bytecode is used, as it is when started by run.sh.
+def measure_import(config_path, runs):
+    py_compile.compile(os.path.join(SCRIPT_DIR, "sunpower_mqtt.py"))
+    code = "import time; start = time.perf_counter(); import sunpower_mqtt; print(time.perf_counter() - start)"
+    environment = dict(os.environ, SUNPOWER_MQTT_CONFIG=config_path, PYTHONPATH=SCRIPT_DIR)
+    times = [float(subprocess.run([sys.executable, "-c", code], env=environment, check=True, capture_output=True, text=True).stdout) for _ in range(runs)]
+    return statistics.median(times) * 1000
+
+
+# Starts the application against the simulators and returns the ms until the first device data is published.
+def measure_first_publish(directory, discovery, timeout=60):
+    connection, child_connection = multiprocessing.Pipe()
+    process = multiprocessing.Process(target=simulator_process, args=(child_connection, 20, 2, 1), daemon=True)
+    process.start()
+    application = None
+    try:
+        ports = connection.recv()
+        config_path = os.path.join(directory, f"config_startup_{discovery}.ini")
+        write_config(config_path, ports, 1)
+        if discovery:
+            # Nothing answers in the documentation subnet, the scan runs until every probe timed out.
+            config = configparser.ConfigParser()
+            config.optionxform = str
+            config.read(config_path)
+            config["ess"]["host"] = ""
+            config["ess"]["subnet"] = "192.0.2.0/24"
+            with open(config_path, "w") as file:
+                config.write(file)
+        environment = dict(os.environ, SUNPOWER_MQTT_CONFIG=config_path, PYTHONPATH=SCRIPT_DIR)
+        start = time.time()
+        application = subprocess.Popen([sys.executable, "-m", "sunpower_mqtt"], env=environment, cwd=directory, stdout=subprocess.DEVNULL)
+        while time.time() - start < timeout and application.poll() is None:
+            connection.send("stats")
+            first_data_time = connection.recv()["first_data_time"]
+            if first_data_time is not None:
+                return (first_data_time - start) * 1000
+            time.sleep(0.01)
+        raise TimeoutError("no device data was published")
+    finally:
+        if application is not None:
+            application.terminate()
+            application.wait()
+        connection.send("stop")
+        process.join(5)
+        if process.is_alive():
+            process.terminate()
+
+
+def run_startup(args):
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        config_path = os.path.join(directory, "config.ini")
+        write_config(config_path, { "pvs": 0, "ess": 0, "mqtt": 0 }, 1)
+        results["import"] = measure_import(config_path, args.startup_runs)
+        for name, discovery in (("first publish", False), ("first publish, ESS discovery", True)):
+            results[name] = statistics.median(measure_first_publish(directory, discovery) for _ in range(args.startup_runs))
+    found = []
+    for name, value in results.items():
+        print(f"{name:>30}: {value:8.1f} ms")
+        budget = args.import_budget if name == "import" else args.startup_budget
+        if value > budget:
+            found.append(f"{name} {value:.1f} ms exceeds the budget of {budget:.1f} ms")
+    for regression in found:
+        print(f"REGRESSION {regression}")
+    return 1 if found else 0
+
+
+def print_results(results, baseline):
+    print(f"{'inverters':>9} {'bats':>4} {'devices':>7} | {'first ms':>8} {'p50 ms':>7} {'p95 ms':>7} {'max ms':>7} | {'pvs':>6} {'ess':>6} {'publish':>7} | {'cpu ms':>7} | {'peak KiB':>8} {'kept KiB':>8} | {'msgs':>6} {'msgs/s':>8}")
+    for result in results:
+        print(f"{result['inverters']:>9} {result['batteries']:>4} {result['devices']:>7} | {result['first_latency']:>8.2f} {result['latency_p50']:>7.2f} {result['latency_p95']:>7.2f} {result['latency_max']:>7.2f} | "
+              f"{result['pvs']:>6.2f} {result['ess']:>6.2f} {result['publish']:>7.2f} | {result['cpu']:>7.2f} | {result['alloc_peak']:>8.1f} {result['alloc_retained']:>8.1f} | "
+              f"{result['messages']:>6.1f} {result['messages_per_second']:>8.0f}")
+        reference = baseline.get((result["inverters"], result["batteries"]))
+        if reference is not None:
+            print(" " * 24 + "vs baseline: " + ", ".join(f"{name} {result[name] / reference[name]:.2f}x" for name in REGRESSION_METRICS if reference.get(name)))
+
+
+def regressions(results, baseline, tolerance):
+    found = []
+    for result in results:
+        reference = baseline.get((result["inverters"], result["batteries"]))
+        if reference is None:
+            continue
+        for name in REGRESSION_METRICS:
+            if reference.get(name) and result[name] > reference[name] * (1 + tolerance):
+                found.append(f"{result['inverters']} inverters, {result['batteries']} batteries: {name} {reference[name]:.2f} -> {result[name]:.2f}")
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the sunpower_mqtt pipeline against simulated devices")
+    parser.add_argument("--inverters", default="10,50,200", help="comma separated inverter counts")
+    parser.add_argument("--batteries", default="0,1,5", help="comma separated battery counts (0 disables the ESS)")
+    parser.add_argument("--meters", type=int, default=2)
+    parser.add_argument("--cycles", type=int, default=50)
+    parser.add_argument("--allocation-cycles", type=int, default=5)
+    parser.add_argument("--save", help="write the results to this JSON file")
+    parser.add_argument("--baseline", help="compare with results saved by --save")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed relative regression against the baseline")
+    parser.add_argument("--startup", action="store_true", help="measure the import time and the time to the first publish instead")
+    parser.add_argument("--startup-runs", type=int, default=5)
+    parser.add_argument("--import-budget", type=float, default=250, help="maximum import time in ms")
+    parser.add_argument("--startup-budget", type=float, default=1000, help="maximum time to the first publish in ms")
+    args = parser.parse_args()
+
+    if args.startup:
+        return run_startup(args)
+
+    baseline = {}
+    if args.baseline is not None:
+        with open(args.baseline) as file:
+            baseline = { (result["inverters"], result["batteries"]): result for result in json.load(file) }
+
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for inverters in (int(value) for value in args.inverters.split(",")):
+            for batteries in (int(value) for value in args.batteries.split(",")):
+                print(f"Running {inverters} inverters, {batteries} batteries...", file=sys.stderr)
+                results.append(run_scenario(directory, inverters, args.meters, batteries, args.cycles, args.allocation_cycles))
+
+    print_results(results, baseline)
+    if args.save is not None:
+        with open(args.save, "w") as file:
+            json.dump(results, file, indent=2)
+    found = regressions(results, baseline, args.tolerance)
+    for regression in found:
+        print(f"REGRESSION {regression}")
+    return 1 if found else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
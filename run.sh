@@ -8,12 +8,11 @@ if [ ! -d "$VENV_DIR" ]; then
   source "${VENV_DIR}/bin/activate"
   pip install paho-mqtt
   pip install netifaces
-  pip install python-nmap
   pip install pyModbusTCP
   pip install aiohttp
 fi
 
 if [ -d "$VENV_DIR" ]; then
   source "${VENV_DIR}/bin/activate"
-  python "${SCRIPT_DIR}/sunpower_mqtt.py"
+  PYTHONPATH="${SCRIPT_DIR}" python -m sunpower_mqtt "$@"
 fi
@@ -0,0 +1,321 @@
+#!/usr/bin/env python3
+
+# Local stand-ins for the PVS, the ESS and the MQTT server so the poll, merge and publish pipeline can be run (and
+# benchmarked) without touching a real system. Every simulator listens on 127.0.0.1 and picks a free port unless
+# one is given, the chosen port is available as .port once start() has returned.
+
+import asyncio
+import json
+import random
+import struct
+import time
+
+import aiohttp.web
+
+
+# Serves /cgi-bin/dl_cgi?Command=DeviceList for a PVS with the given number of inverters, power meters and
+# batteries. Readings drift a little on every request so delta publishing sees realistic changes.
+class PvsSimulator:
+    def __init__(self, inverters=20, meters=2, batteries=1, host="127.0.0.1", port=0, seed=None):
+        self.inverters = inverters
+        self.meters = meters
+        self.batteries = batteries
+        self.host = host
+        self.port = port
+        self.random = random.Random(seed)
+        self.requests = 0
+        self.runner = None
+        self.energy = [self.random.uniform(500, 2000) for _ in range(inverters)]
+        self.meter_energy = [self.random.uniform(5000, 20000) for _ in range(meters)]
+        self.started = time.time()
+
+    def _reading(self, value, digits):
+        return f"{value:.{digits}f}"
+
+    def devices(self):
+        uptime = int(time.time() - self.started)
+        devices = [{
+            "DEVICE_TYPE": "PVS", "SERIAL": "ZT000000000000000000", "MODEL": "PV Supervisor PVS6", "HWVER": "6.02",
+            "SWVER": "2021.9, Build 41001", "STATE": "working", "dl_err_count": "0", "dl_comm_err": "0",
+            "dl_skipped_scans": "0", "dl_scan_time": "1", "dl_untransmitted": "0", "dl_uptime": str(uptime),
+            "dl_cpu_load": self._reading(self.random.uniform(0.2, 1.5), 2), "dl_mem_used": str(self.random.randint(90000, 110000)),
+            "dl_flash_avail": "65000",
+        }]
+        for meter in range(self.meters):
+            self.meter_energy[meter] += self.random.uniform(0, 0.05)
+            devices.append({
+                "DEVICE_TYPE": "Power Meter", "SERIAL": f"PVS6M000000{meter:02d}{'p' if meter == 0 else 'c'}",
+                "MODEL": f"PVS6M0400{'p' if meter == 0 else 'c'}", "SWVER": "3000", "STATE": "working",
+                "net_ltea_3phsum_kwh": self._reading(self.meter_energy[meter], 2),
+                "neg_ltea_3phsum_kwh": self._reading(self.meter_energy[meter] * 0.4, 2),
+                "pos_ltea_3phsum_kwh": self._reading(self.meter_energy[meter] * 1.4, 2),
+                "p_3phsum_kw": self._reading(self.random.uniform(-5, 5), 4), "freq_hz": "60",
+            })
+        for inverter in range(self.inverters):
+            power = self.random.uniform(0, 0.35)
+            self.energy[inverter] += power / 120
+            devices.append({
+                "DEVICE_TYPE": "Inverter", "SERIAL": f"E00122{inverter:011d}", "MODEL": "AC_Module_Type_E",
+                "hw_version": "4403", "SWVER": "4.21.4", "STATE": "working", "STATEDESCR": "Working",
+                "ltea_3phsum_kwh": self._reading(self.energy[inverter], 4), "p_mppt1_kw": self._reading(power, 4),
+                "v_mppt1_v": self._reading(self.random.uniform(45, 60), 2), "i_mppt1_a": self._reading(self.random.uniform(0, 6), 2),
+                "t_htsnk_degc": str(self.random.randint(20, 60)), "freq_hz": "60", "stat_ind": "0",
+            })
+        if self.batteries > 0:
+            devices += [
+                { "DEVICE_TYPE": "HUB+", "SERIAL": "PVS5M000000000h", "MODEL": "HUB+", "hw_version": "0.1.0", "SWVER": "0.3.8" },
+                { "DEVICE_TYPE": "ESS Hub", "SERIAL": "M00000000000", "MODEL": "SPWR-Equinox-model", "hw_version": "0.2.0", "SWVER": "0.3.9",
+                  "t_degc": self._reading(self.random.uniform(20, 40), 1), "humidity": str(self.random.randint(20, 60)), "fw_error": "0", "event_history": "0" },
+                { "DEVICE_TYPE": "PV Disconnect", "SERIAL": "SY00000000000", "MODEL": "PV Disconnect", "hw_version": "0.2.0", "SWVER": "0.2.8",
+                  "event_history": "0", "fw_error": "0", "relay_mode": "0", "relay1_state": "1", "relay2_state": "1", "relay1_error": "0",
+                  "relay2_error": "0", "relay1_counter": "10", "relay2_counter": "10" },
+                { "DEVICE_TYPE": "Gateway", "SERIAL": "SBG0000000000", "MODEL": "SchneiderElectric-ConextGateway", "SWVER": "V1" },
+                { "DEVICE_TYPE": "Storage Inverter", "SERIAL": "0000000000", "MODEL": "SchneiderElectric-XW6848-21", "SWVER": "V1" },
+                { "DEVICE_TYPE": "Energy Storage System", "SERIAL": "0000000000000", "MODEL": "SPWR-Equinox-model", "hw_version": "0", "SWVER": "0" },
+            ]
+            for battery in range(self.batteries):
+                devices.append({ "DEVICE_TYPE": "ESS BMS", "SERIAL": f"BC00000000{battery:02d}", "MODEL": "POWERAMP-Komodo 1.2", "SWVER": "2.8" })
+                devices.append({ "DEVICE_TYPE": "Battery", "SERIAL": f"M000000000{battery:02d}", "MODEL": "POWERAMP-Komodo 1.2", "hw_version": "0", "SWVER": "0" })
+        return devices
+
+    def body(self):
+        return json.dumps({ "devices": self.devices(), "result": "succeed" })
+
+    async def handle(self, request):
+        if request.query.get("Command") != "DeviceList":
+            raise aiohttp.web.HTTPNotFound()
+        self.requests += 1
+        return aiohttp.web.Response(text=self.body(), content_type="text/html")
+
+    async def start(self):
+        app = aiohttp.web.Application()
+        app.router.add_get("/cgi-bin/dl_cgi", self.handle)
+        self.runner = aiohttp.web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        site = aiohttp.web.TCPSite(self.runner, self.host, self.port)
+        await site.start()
+        self.port = self.runner.addresses[0][1]
+
+    async def stop(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
+
+
+# Modbus TCP server answering read holding registers (function 3) from a register map in the ESS_REGISTERS
+# format. Addresses outside the map read as zero. Readings drift whenever a read starts at or below the address of
+# the previous one, which is when a client begins a new pass over its (address ordered) read plan.
+class EssSimulator:
+    def __init__(self, registers, batteries=1, host="127.0.0.1", port=0, seed=None):
+        self.registers = registers
+        self.batteries = batteries
+        self.host = host
+        self.port = port
+        self.random = random.Random(seed)
+        self.requests = 0
+        self.server = None
+        self.last_address = -1
+        self.values = {}
+        for name, register in registers.items():
+            if register["type"].startswith("string"):
+                self.values[name] = { "device_name": "Conext Gateway", "firmware_version": "V1.14.1 Build 1", "serial_number": "SBG0000000000" }.get(name, "")
+            elif name.endswith("_soc"):
+                self.values[name] = self.random.randint(20, 100)
+            elif name.endswith("_soh"):
+                self.values[name] = self.random.randint(90, 100)
+            elif name == "utc_time":
+                self.values[name] = int(time.time())
+            elif register["type"] in ("uint32", "int32") and "_" in name and name.split("_")[-1] in ("total", "year", "month", "week", "today", "hour"):
+                self.values[name] = self.random.randint(0, 5000000)
+            else:
+                self.values[name] = 0
+        self.words = self._encode()
+
+    def _encode(self):
+        words = {}
+        for name, register in self.registers.items():
+            value = self.values[name]
+            if register["type"].startswith("string"):
+                size = int(register["type"].replace("string", ""))
+                data = value.encode("utf-8")[:size].ljust(size, b"\x00")
+                values = struct.unpack(f">{size // 2}H", data)
+            elif register["type"] in ("uint32", "int32"):
+                values = struct.unpack(">HH", struct.pack(">I", value & 0xFFFFFFFF))
+            else:
+                values = (value & 0xFFFF,)
+            for offset, word in enumerate(values):
+                words[register["address"] + offset] = word
+        return words
+
+    # Moves the readings along as a real system would between two reads.
+    def step(self):
+        power = self.random.randint(-5000, 5000)
+        self.values["battery_power_net"] = power
+        self.values["utc_time"] = int(time.time())
+        for battery in range(1, self.batteries + 1):
+            for name, delta in ((f"bat{battery}_soc", 1 if power > 0 else -1), (f"bat{battery}_charge_total", max(power, 0) // 100), (f"bat{battery}_invert_total", max(-power, 0) // 100)):
+                if name in self.values:
+                    self.values[name] = min(self.values[name] + delta, 100) if name.endswith("_soc") else self.values[name] + delta
+        self.words = self._encode()
+
+    def read(self, address, count):
+        return [self.words.get(address + offset, 0) for offset in range(count)]
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                header = await reader.readexactly(7)
+                transaction, protocol, length, unit = struct.unpack(">HHHB", header)
+                pdu = await reader.readexactly(length - 1)
+                function = pdu[0]
+                if function == 3 and len(pdu) == 5:
+                    address, count = struct.unpack(">HH", pdu[1:5])
+                    if count < 1 or count > 125:
+                        response = struct.pack(">BB", function | 0x80, 3)
+                    else:
+                        self.requests += 1
+                        if address <= self.last_address:
+                            self.step()
+                        self.last_address = address
+                        words = self.read(address, count)
+                        response = struct.pack(f">BB{count}H", function, count * 2, *words)
+                else:
+                    response = struct.pack(">BB", function | 0x80, 1)
+                writer.write(struct.pack(">HHHB", transaction, protocol, len(response) + 1, unit) + response)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+
+
+# Minimal MQTT 3.1.1 / 5 server that accepts any client and counts what is published to it. It keeps the last
+# payload per topic (like a retained message store) but does not forward anything to subscribers.
+class MqttSink:
+    def __init__(self, host="127.0.0.1", port=0):
+        self.host = host
+        self.port = port
+        self.server = None
+        self.messages = 0
+        self.bytes = 0
+        self.topics = {}
+        # Time each topic was first published to, used to measure how soon after starting data arrives.
+        self.first_times = {}
+
+    async def _read_packet(self, reader):
+        header = (await reader.readexactly(1))[0]
+        length, shift = 0, 0
+        while True:
+            byte = (await reader.readexactly(1))[0]
+            length += (byte & 0x7F) << shift
+            shift += 7
+            if byte & 0x80 == 0:
+                break
+        return header, await reader.readexactly(length)
+
+    @staticmethod
+    def _variable_int(data, position):
+        value, shift = 0, 0
+        while True:
+            byte = data[position]
+            position += 1
+            value += (byte & 0x7F) << shift
+            shift += 7
+            if byte & 0x80 == 0:
+                return value, position
+
+    async def handle(self, reader, writer):
+        version = 4
+        try:
+            while True:
+                header, body = await self._read_packet(reader)
+                packet_type = header >> 4
+                if packet_type == 1:  # CONNECT
+                    version = body[2 + struct.unpack(">H", body[:2])[0]]
+                    writer.write(b"\x20\x03\x00\x00\x00" if version == 5 else b"\x20\x02\x00\x00")
+                elif packet_type == 3:  # PUBLISH
+                    qos = (header >> 1) & 0x03
+                    topic_length = struct.unpack(">H", body[:2])[0]
+                    topic = body[2:2 + topic_length].decode("utf-8")
+                    position = 2 + topic_length
+                    packet_id = None
+                    if qos > 0:
+                        packet_id = body[position:position + 2]
+                        position += 2
+                    if version == 5:
+                        properties, position = self._variable_int(body, position)
+                        position += properties
+                    payload = body[position:]
+                    self.messages += 1
+                    self.bytes += len(payload)
+                    self.topics[topic] = payload
+                    self.first_times.setdefault(topic, time.time())
+                    if qos == 1:
+                        writer.write(b"\x40\x02" + packet_id)
+                    elif qos == 2:
+                        writer.write(b"\x50\x02" + packet_id)
+                elif packet_type == 6:  # PUBREL
+                    writer.write(b"\x70\x02" + body[:2])
+                elif packet_type == 8:  # SUBSCRIBE
+                    writer.write(b"\x90\x04" + body[:2] + b"\x00\x00" if version == 5 else b"\x90\x03" + body[:2] + b"\x00")
+                elif packet_type == 12:  # PINGREQ
+                    writer.write(b"\xd0\x00")
+                elif packet_type == 14:  # DISCONNECT
+                    break
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+
+
+# Runs the simulators until interrupted so sunpower_mqtt.py (or anything else) can be pointed at them.
+async def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="Simulate a PVS, an ESS and an MQTT server")
+    parser.add_argument("--inverters", type=int, default=20)
+    parser.add_argument("--meters", type=int, default=2)
+    parser.add_argument("--batteries", type=int, default=1)
+    parser.add_argument("--pvs-port", type=int, default=8080)
+    parser.add_argument("--ess-port", type=int, default=5020)
+    parser.add_argument("--mqtt-port", type=int, default=1883)
+    args = parser.parse_args()
+
+    from sunpower_mqtt import ESS_REGISTERS
+    pvs = PvsSimulator(args.inverters, args.meters, args.batteries, port=args.pvs_port)
+    ess = EssSimulator(ESS_REGISTERS, args.batteries, port=args.ess_port)
+    sink = MqttSink(port=args.mqtt_port)
+    for simulator in (pvs, ess, sink):
+        await simulator.start()
+    print(f"PVS on 127.0.0.1:{pvs.port}, ESS on 127.0.0.1:{ess.port}, MQTT on 127.0.0.1:{sink.port}")
+    try:
+        while True:
+            await asyncio.sleep(60)
+            print(f"PVS requests: {pvs.requests}, ESS requests: {ess.requests}, MQTT messages: {sink.messages}")
+    finally:
+        for simulator in (pvs, ess, sink):
+            await simulator.stop()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
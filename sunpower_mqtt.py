@@ -1,44 +1,253 @@
+from array import array
 import asyncio
+import codecs
+import collections
+from concurrent.futures import ThreadPoolExecutor
 import configparser
+import csv
+import functools
+import hashlib
+import inspect
+import io
+import itertools
 from ipaddress import IPv4Network
 import json
+import math
+import mmap
+import multiprocessing
+import multiprocessing.connection
+import operator
 import os
+import random
+import re
+import signal
+import struct
+import sys
 import time
+import zlib
 
-import aiohttp
-import netifaces
-import nmap
-import paho.mqtt.publish as publish
-from pyModbusTCP.client import ModbusClient
+# aiohttp, netifaces, paho-mqtt and pyModbusTCP are imported by the functions that use them, so importing this
+# module is quick and only needs the standard library. Every setting has a default, a missing config file only
+# changes what run() does.
 
-config_path = os.path.join(os.path.abspath(os.path.dirname(__file__)), "config.ini")
+config_path = os.environ.get("SUNPOWER_MQTT_CONFIG", os.path.join(os.path.abspath(os.path.dirname(__file__)), "config.ini"))
 config = configparser.ConfigParser()
 config.read(config_path)
 
-PVS_SAMPLE_PERIOD = float(config["pvs"]["sample_period"])
+ESS_SCAN_CONCURRENCY = config.getint("ess", "scan_concurrency", fallback=64)
+ESS_SCAN_TIMEOUT = config.getfloat("ess", "scan_timeout", fallback=1.0)
+ESS_SCAN_VERIFY = config.getboolean("ess", "scan_verify", fallback=True)
+ESS_RECONNECT_MIN = config.getfloat("ess", "reconnect_min", fallback=1.0)
+ESS_RECONNECT_MAX = config.getfloat("ess", "reconnect_max", fallback=120.0)
+ESS_MAX_READ_COUNT = 125
 
-ESS_ENABLED = config["ess"].getboolean("enabled")
-ESS_SAMPLE_PERIOD = float(config["ess"]["sample_period"])
-ESS_HOST = config["ess"]["host"]
-ESS_PORT = int(config["ess"]["port"])
-ESS_UNIT_ID = int(config["ess"]["unit_id"])
-ESS_TIMEOUT = int(config["ess"]["timeout"])
-ESS_BATTERY_COUNT = int(config["ess"]["battery_count"])
+# Sites served by this process, see Site. Without names the pvs and ess sections describe the only site. With
+# workers set above 1 the sites are split across that many worker processes.
+SITE_NAMES = [name.strip() for name in config.get("sites", "names", fallback="").split(",") if name.strip() != ""]
+SITE_WORKERS = config.getint("sites", "workers", fallback=0)
 
-MQTT_ENABLED = config["mqtt"].getboolean("enabled")
-MQTT_PUBLISH_PERIOD = float(config["mqtt"]["publish_period"])
-MQTT_HOST = config["mqtt"]["host"]
-MQTT_PORT = int(config["mqtt"]["port"])
-MQTT_USERNAME = config["mqtt"]["username"]
-MQTT_PASSWORD = config["mqtt"]["password"]
-MQTT_TOPIC_PREFIX = config["mqtt"]["topic_prefix"]
+MQTT_ENABLED = config.getboolean("mqtt", "enabled", fallback=False)
+MQTT_PUBLISH_PERIOD = config.getfloat("mqtt", "publish_period", fallback=30)
+MQTT_HOST = config.get("mqtt", "host", fallback="localhost")
+MQTT_PORT = config.getint("mqtt", "port", fallback=1883)
+MQTT_USERNAME = config.get("mqtt", "username", fallback="")
+MQTT_PASSWORD = config.get("mqtt", "password", fallback="")
+MQTT_TOPIC_PREFIX = config.get("mqtt", "topic_prefix", fallback="sunpower")
+MQTT_QOS = config.getint("mqtt", "qos", fallback=1)
+MQTT_MAX_INFLIGHT = config.getint("mqtt", "max_inflight", fallback=20)
+MQTT_KEEPALIVE = config.getint("mqtt", "keepalive", fallback=60)
+MQTT_HEARTBEAT_PERIOD = config.getfloat("mqtt", "heartbeat_period", fallback=300)
+MQTT_STATUS_TOPIC = f"{MQTT_TOPIC_PREFIX}/status"
 
-HOMEASSISTANT_SEND_CONFIG = config["homeassistant"].getboolean("send_config")
+SCHEDULER_BACKOFF_MIN = config.getfloat("scheduler", "backoff_min", fallback=5)
+SCHEDULER_BACKOFF_MAX = config.getfloat("scheduler", "backoff_max", fallback=600)
+SCHEDULER_JITTER = config.getfloat("scheduler", "jitter", fallback=0.2)
 
-SERIAL_TO_ID_ENABLED = config["serial_to_id"].getboolean("enabled")
+BUFFER_ENABLED = config.getboolean("buffer", "enabled", fallback=False)
+BUFFER_PATH = os.path.join(os.path.dirname(config_path), config.get("buffer", "path", fallback="buffer.bin"))
+BUFFER_SIZE = int(config.getfloat("buffer", "size", fallback=16) * 1024 * 1024)
+BUFFER_DRAIN_BATCH = config.getint("buffer", "drain_batch", fallback=100)
+BUFFER_DRAIN_PERIOD = config.getfloat("buffer", "drain_period", fallback=1)
+
+HISTORY_ENABLED = config.getboolean("history", "enabled", fallback=False)
+HISTORY_ALL_NUMERIC = config.getboolean("history", "all_numeric", fallback=False)
+HISTORY_RAW_SAMPLES = config.getint("history", "raw_samples", fallback=288)
+HISTORY_FIVE_MINUTE_BUCKETS = config.getint("history", "five_minute_buckets", fallback=2016)
+HISTORY_HOURLY_BUCKETS = config.getint("history", "hourly_buckets", fallback=2160)
+
+ROLLUP_PUBLISH = config.getboolean("rollup", "publish", fallback=False)
+ROLLUP_OUTLIER_THRESHOLD = config.getfloat("rollup", "outlier_threshold", fallback=0.25)
+
+METRICS_ENABLED = config.getboolean("metrics", "enabled", fallback=False)
+METRICS_HOST = config.get("metrics", "host", fallback="0.0.0.0")
+METRICS_PORT = config.getint("metrics", "port", fallback=9108)
+METRICS_MQTT = config.getboolean("metrics", "mqtt", fallback=False)
+
+API_ENABLED = config.getboolean("api", "enabled", fallback=False)
+API_HOST = config.get("api", "host", fallback="0.0.0.0")
+API_PORT = config.getint("api", "port", fallback=9110)
+API_KEEPALIVE = config.getfloat("api", "keepalive", fallback=15)
+
+# Export sinks, each section also sets batch_size, flush_interval and queue_size (see ExportSink).
+EXPORT_LINE_PROTOCOL_ENABLED = config.getboolean("export.line_protocol", "enabled", fallback=False)
+EXPORT_LINE_PROTOCOL_PATH = os.path.join(os.path.dirname(config_path), config.get("export.line_protocol", "path", fallback="export.lp"))
+EXPORT_LINE_PROTOCOL_ROTATE_SIZE = config.getfloat("export.line_protocol", "rotate_size", fallback=100) * 1024 * 1024
+EXPORT_LINE_PROTOCOL_ROTATE_COUNT = config.getint("export.line_protocol", "rotate_count", fallback=5)
+EXPORT_CSV_ENABLED = config.getboolean("export.csv", "enabled", fallback=False)
+EXPORT_CSV_DIRECTORY = os.path.join(os.path.dirname(config_path), config.get("export.csv", "directory", fallback="export"))
+EXPORT_MQTT_ENABLED = config.getboolean("export.mqtt", "enabled", fallback=False)
+EXPORT_MQTT_TOPIC = f"{MQTT_TOPIC_PREFIX}/{config.get('export.mqtt', 'topic', fallback='export')}"
+
+HOMEASSISTANT_SEND_CONFIG = config.getboolean("homeassistant", "send_config", fallback=True)
+
+SERIAL_TO_ID_ENABLED = config.getboolean("serial_to_id", "enabled", fallback=False)
 SERIAL_TO_ID_MAP = { }
-for key in config["serial_to_id"]:
-    SERIAL_TO_ID_MAP[key] = config["serial_to_id"][key]
+if config.has_section("serial_to_id"):
+    for key in config["serial_to_id"]:
+        SERIAL_TO_ID_MAP[key] = config["serial_to_id"][key]
+
+# Numeric fields are only republished when they move by more than their deadband, keyed by (device type, field).
+# Malformed entries are skipped with a warning rather than stopping the bridge.
+MQTT_DEADBANDS = { }
+if config.has_section("deadband"):
+    for key in config["deadband"]:
+        device_type, _, field = key.partition(".")
+        if device_type == "" or field == "":
+            print(f"Ignoring deadband {key!r}, expected a key of the form device_type.field")
+            continue
+        try:
+            MQTT_DEADBANDS[(device_type, field)] = config.getfloat("deadband", key)
+        except ValueError:
+            print(f"Ignoring deadband {key!r}, {config['deadband'][key]!r} is not a number")
+
+
+# Counters, gauges and latency histograms, exported in the Prometheus text format. Every metric is keyed by its name
+# and labels, collectors are called before rendering to refresh gauges that are cheaper to read on demand.
+class Metrics:
+    BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+    def __init__(self):
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.collectors = []
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        self.gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = [[0] * len(self.BUCKETS), 0.0, 0]
+        for index, bucket in enumerate(self.BUCKETS):
+            if value <= bucket:
+                histogram[0][index] += 1
+                break
+        histogram[1] += value
+        histogram[2] += 1
+
+    def collect(self):
+        for collector in self.collectors:
+            collector(self)
+
+    # Label values are escaped as the text format requires.
+    @staticmethod
+    def _escape(value):
+        return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+    @classmethod
+    def _labels(cls, labels, extra=()):
+        labels = tuple(labels) + tuple(extra)
+        if len(labels) == 0:
+            return ""
+        return "{" + ",".join(f'{key}="{cls._escape(value)}"' for key, value in labels) + "}"
+
+    def render(self):
+        self.collect()
+        lines = []
+        for kind, metrics in (("counter", self.counters), ("gauge", self.gauges)):
+            for name in sorted({ name for name, _ in metrics }):
+                lines.append(f"# TYPE {name} {kind}")
+                lines += [f"{name}{self._labels(labels)} {value}" for (metric_name, labels), value in metrics.items() if metric_name == name]
+        for name in sorted({ name for name, _ in self.histograms }):
+            lines.append(f"# TYPE {name} histogram")
+            for (metric_name, labels), (counts, total, count) in self.histograms.items():
+                if metric_name != name:
+                    continue
+                cumulative = 0
+                for bucket, bucket_count in zip(self.BUCKETS, counts):
+                    cumulative += bucket_count
+                    lines.append(f"{name}_bucket{self._labels(labels, [('le', bucket)])} {cumulative}")
+                lines.append(f"{name}_bucket{self._labels(labels, [('le', '+Inf')])} {count}")
+                lines.append(f"{name}_sum{self._labels(labels)} {total}")
+                lines.append(f"{name}_count{self._labels(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+    # Flattened snapshot used for the MQTT diagnostics topic, histograms are reduced to their count and sum.
+    def summary(self):
+        self.collect()
+        summary = {}
+        for metrics in (self.counters, self.gauges):
+            for (name, labels), value in metrics.items():
+                summary[name + "".join(f"_{value}" for _, value in labels)] = value
+        for (name, labels), (_, total, count) in self.histograms.items():
+            key = name + "".join(f"_{value}" for _, value in labels)
+            summary[key + "_count"] = count
+            summary[key + "_sum"] = total
+        return summary
+
+
+METRICS = Metrics()
+
+
+# Records the duration of every call of the decorated function in the named histogram and counts the calls that
+# raised in sunpower_errors_total.
+def timed(name):
+    def decorator(function):
+        if inspect.iscoroutinefunction(function):
+            @functools.wraps(function)
+            async def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return await function(*args, **kwargs)
+                except Exception:
+                    METRICS.inc("sunpower_errors_total", function=function.__name__)
+                    raise
+                finally:
+                    METRICS.observe(name, time.perf_counter() - start)
+        else:
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return function(*args, **kwargs)
+                except Exception:
+                    METRICS.inc("sunpower_errors_total", function=function.__name__)
+                    raise
+                finally:
+                    METRICS.observe(name, time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+
+async def metrics_handler(request):
+    import aiohttp.web
+    return aiohttp.web.Response(text=METRICS.render(), content_type="text/plain", charset="utf-8", headers={ "X-Content-Type-Options": "nosniff" })
+
+
+async def metrics_start_server():
+    import aiohttp.web
+    app = aiohttp.web.Application()
+    app.router.add_get("/metrics", metrics_handler)
+    runner = aiohttp.web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await aiohttp.web.TCPSite(runner, METRICS_HOST, METRICS_PORT).start()
+    return runner
 
 
 # List of all PVS (includes ESS) data that is published to the MQTT server (where applicable).
@@ -111,8 +320,12 @@ PVS_METADATA = {
             "inverter_total":   { "name": "Inverter Total",   "source": "ess", "raw_name": "dc_input_total",    "transform": None,                                                    "state_class": "total_increasing", "device_class": "energy",      "unit_of_measurement": "kWh" }, # Comes from modbus register
             "charge_total":     { "name": "Charge Total",     "source": "ess", "raw_name": "dc_output_total",   "transform": None,                                                    "state_class": "total_increasing", "device_class": "energy",      "unit_of_measurement": "kWh" }, # Comes from modbus register
             "power":            { "name": "Power",            "source": "ess", "raw_name": "battery_power_net", "transform": None,                                                    "state_class": "measurement",      "device_class": "power",       "unit_of_measurement": "kW" }, # Comes from modbus register
-            "charge":           { "name": "Charge",           "source": "ess", "raw_name": "",                  "transform": lambda _: manual_average(PVS_DATA, "ess_bms", "charge"), "state_class": None,               "device_class": "battery",     "unit_of_measurement": "%" }, # Calculated as average of ess_bms/charge
-            "health":           { "name": "Health",           "source": "ess", "raw_name": "",                  "transform": lambda _: manual_average(PVS_DATA, "ess_bms", "health"), "state_class": None,               "device_class": "measurement", "unit_of_measurement": "%" }, # Calculated as average of ess_bms/health
+            "charge":           { "name": "Charge",           "source": "ess", "raw_name": "",                  "transform": lambda site: site.rollups["ess_bms"].mean("charge"),     "state_class": None,               "device_class": "battery",     "unit_of_measurement": "%" }, # Calculated as average of ess_bms/charge
+            "health":           { "name": "Health",           "source": "ess", "raw_name": "",                  "transform": lambda site: site.rollups["ess_bms"].mean("health"),     "state_class": None,               "device_class": "measurement", "unit_of_measurement": "%" }, # Calculated as average of ess_bms/health
+            "firmware_version": { "name": "Firmware Version", "source": "ess", "raw_name": "firmware_version",  "transform": lambda x: x.strip("\x00 "),                              "state_class": None,               "device_class": None,          "unit_of_measurement": None }, # Comes from modbus register
+            "system_status":    { "name": "System Status",    "source": "ess", "raw_name": "system_status",     "transform": None,                                                    "state_class": None,               "device_class": None,          "unit_of_measurement": None }, # Comes from modbus register
+            "system_faults":    { "name": "System Faults",    "source": "ess", "raw_name": "system_faults",     "transform": None,                                                    "state_class": None,               "device_class": None,          "unit_of_measurement": None }, # Comes from modbus register
+            "system_warnings":  { "name": "System Warnings",  "source": "ess", "raw_name": "system_warnings",   "transform": None,                                                    "state_class": None,               "device_class": None,          "unit_of_measurement": None }, # Comes from modbus register
         },
     },
     "storage_inverter": {
@@ -181,101 +394,151 @@ PVS_METADATA = {
     },
 }
 
+# Site wide rollups computed across all devices of a device type. For each field the statistics to compute, total,
+# min, max and mean publish the matching value and outliers publishes the number of devices that are more than
+# outlier_threshold below the mean of their peers (their serial numbers are listed in the <field>_outliers_list).
+ROLLUP_FIELDS = {
+    "inverter": {
+        "power":          ["total", "min", "max", "mean", "outliers"],
+        "energy_total":   ["total", "min", "max", "mean", "outliers"],
+        "temperature":    ["min", "max", "mean"],
+    },
+    "ess_bms": {
+        "charge":         ["min", "max", "mean"],
+        "health":         ["min", "max", "mean"],
+        "charge_total":   ["total"],
+        "inverter_total": ["total"],
+    },
+}
+
+ROLLUP_STATISTIC_NAMES = { "total": "Total", "min": "Min", "max": "Max", "mean": "Mean", "outliers": "Outliers" }
+
+
+# Adds a virtual site_<device type> device to PVS_METADATA for every device type that has rollups. The outlier
+# serial number lists are published in the device data but not as entities, they are listed in extra_fields.
+def rollup_metadata(device_type):
+    fields = {
+        "model":         { "name": "Model",         "source": "rollup", "raw_name": "", "transform": None, "state_class": None, "device_class": None, "unit_of_measurement": None },
+        "serial_number": { "name": "Serial Number", "source": "rollup", "raw_name": "", "transform": None, "state_class": None, "device_class": None, "unit_of_measurement": None },
+        "devices":       { "name": "Devices",       "source": "rollup", "raw_name": "", "transform": None, "state_class": "measurement", "device_class": None, "unit_of_measurement": None },
+    }
+    for field, statistics in ROLLUP_FIELDS[device_type].items():
+        field_metadata = PVS_METADATA[device_type]['fields'][field]
+        for statistic in statistics:
+            state_class = field_metadata['state_class'] if statistic == "total" else "measurement"
+            device_class = field_metadata['device_class'] if statistic != "outliers" else None
+            unit_of_measurement = field_metadata['unit_of_measurement'] if statistic != "outliers" else None
+            fields[f"{field}_{statistic}"] = { "name": f"{field_metadata['name']} {ROLLUP_STATISTIC_NAMES[statistic]}", "source": "rollup", "raw_name": "", "transform": None, "state_class": state_class, "device_class": device_class, "unit_of_measurement": unit_of_measurement }
+    extra_fields = [f"{field}_outliers_list" for field, statistics in ROLLUP_FIELDS[device_type].items() if "outliers" in statistics]
+    return { "name": f"Site {PVS_METADATA[device_type]['name']}", "fields": fields, "extra_fields": extra_fields }
+
+
+if ROLLUP_PUBLISH:
+    for device_type in ROLLUP_FIELDS:
+        PVS_METADATA[f"site_{device_type}"] = rollup_metadata(device_type)
+
 # List of all ESS modbus registers to read on the 503 port.
 # - address = modbus address
 # - type = type of data at address, supported types are int16, uint16, int32, uint32, and stringX (where X is the number of characters)
 # - field_name = function to get the field name from the register name
+# - refresh = how often the register is read, static registers are read once, slow registers every slow_sample_period
+#   and fast registers every ESS sample
 # - transform = function to transform the data from the register
 ESS_REGISTERS = {
-    "device_name":         { "address": 0x0000, "type": "string16", "transform": None }, # Not particularly useful information
-    "firmware_version":    { "address": 0x001E, "type": "string20", "transform": None }, 
-    "serial_number":       { "address": 0x002B, "type": "string16", "transform": None },
-    "utc_time":            { "address": 0x003A, "type": "uint32",   "transform": None }, # Has the time as UNIX (s)
-    "system_status":       { "address": 0x0040, "type": "uint16",   "transform": None }, # Unknown
-    "system_faults":       { "address": 0x0041, "type": "uint16",   "transform": None }, # Unknown
-    "generator_state":     { "address": 0x0042, "type": "uint16",   "transform": None }, # Unknown
-    "system_warnings":     { "address": 0x0043, "type": "uint16",   "transform": None }, # Unknown
-    "dc_input_today":      { "address": 0x00A4, "type": "uint32",   "transform": lambda x: x * 0.001 }, # Sum of bat*_invert_today
-    "dc_input_total":      { "address": 0x00B4, "type": "uint32",   "transform": lambda x: x * 0.001 }, # Sum of bat*_invert_total
-    "dc_output_today":     { "address": 0x00BC, "type": "uint32",   "transform": lambda x: x * 0.001 }, # Sum of bat*_charge_today
-    "dc_output_total":     { "address": 0x00CC, "type": "uint32",   "transform": lambda x: x * 0.001 }, # Sum of bat*_charge_total
-    "grid_input_today":    { "address": 0x00D4, "type": "uint32",   "transform": lambda x: x * 0.001 }, # Something (appears to be to the battery, slightly different from dc_output_today)
-    "grid_output_today":   { "address": 0x00EC, "type": "uint32",   "transform": lambda x: x * 0.001 }, # Something (appears to be from the battery to grid/house, slightly different from dc_input_today)
-    "battery_power_net":   { "address": 0x0158, "type": "int32",    "transform": lambda x: x * 0.001 }, # Negative = Powering Home, Position = Charging Battery, 0 = Nothing is happening
-    "bat1_charge_hour":    { "address": 0x0280, "type": "uint32",   "transform": lambda x: x * 0.001 },
-    "bat1_charge_today":   { "address": 0x0282, "type": "uint32",   "transform": lambda x: x * 0.001 },
-    "bat1_charge_week":    { "address": 0x0284, "type": "uint32",   "transform": lambda x: x * 0.001 },
-    "bat1_charge_month":   { "address": 0x0286, "type": "uint32",   "transform": lambda x: x * 0.001 },
-    "bat1_charge_year":    { "address": 0x0288, "type": "uint32",   "transform": lambda x: x * 0.001 },
-    "bat1_charge_total":   { "address": 0x028A, "type": "uint32",   "transform": lambda x: x * 0.001 },
-    "bat1_invert_hour":    { "address": 0x0298, "type": "uint32",   "transform": lambda x: x * 0.001 },
-    "bat1_invert_today":   { "address": 0x029A, "type": "uint32",   "transform": lambda x: x * 0.001 },
-    "bat1_invert_week":    { "address": 0x029C, "type": "uint32",   "transform": lambda x: x * 0.001 },
-    "bat1_invert_month":   { "address": 0x029E, "type": "uint32",   "transform": lambda x: x * 0.001 },
-    "bat1_invert_year":    { "address": 0x02A0, "type": "uint32",   "transform": lambda x: x * 0.001 },
-    "bat1_invert_total":   { "address": 0x02A2, "type": "uint32",   "transform": lambda x: x * 0.001 },
-    "bat2_charge_hour":    { "address": 0x02B0, "type": "uint32",   "transform": lambda x: x * 0.001 },
-    "bat2_charge_today":   { "address": 0x02B2, "type": "uint32",   "transform": lambda x: x * 0.001 },
-    "bat2_charge_week":    { "address": 0x02B4, "type": "uint32",   "transform": lambda x: x * 0.001 },
-    "bat2_charge_month":   { "address": 0x02B6, "type": "uint32",   "transform": lambda x: x * 0.001 },
-    "bat2_charge_year":    { "address": 0x02B8, "type": "uint32",   "transform": lambda x: x * 0.001 },
-    "bat2_charge_total":   { "address": 0x02BA, "type": "uint32",   "transform": lambda x: x * 0.001 },
-    "bat2_invert_hour":    { "address": 0x02C8, "type": "uint32",   "transform": lambda x: x * 0.001 },
-    "bat2_invert_today":   { "address": 0x02CA, "type": "uint32",   "transform": lambda x: x * 0.001 },
-    "bat2_invert_week":    { "address": 0x02CC, "type": "uint32",   "transform": lambda x: x * 0.001 },
-    "bat2_invert_month":   { "address": 0x02CE, "type": "uint32",   "transform": lambda x: x * 0.001 },
-    "bat2_invert_year":    { "address": 0x02C0, "type": "uint32",   "transform": lambda x: x * 0.001 },
-    "bat2_invert_total":   { "address": 0x02C2, "type": "uint32",   "transform": lambda x: x * 0.001 },
-    "bat3_charge_hour":    { "address": 0x02E0, "type": "uint32",   "transform": lambda x: x * 0.001 },
-    "bat3_charge_today":   { "address": 0x02E2, "type": "uint32",   "transform": lambda x: x * 0.001 },
-    "bat3_charge_week":    { "address": 0x02E4, "type": "uint32",   "transform": lambda x: x * 0.001 },
-    "bat3_charge_month":   { "address": 0x02E6, "type": "uint32",   "transform": lambda x: x * 0.001 },
-    "bat3_charge_year":    { "address": 0x02E8, "type": "uint32",   "transform": lambda x: x * 0.001 },
-    "bat3_charge_total":   { "address": 0x02EA, "type": "uint32",   "transform": lambda x: x * 0.001 },
-    "bat3_invert_hour":    { "address": 0x02F8, "type": "uint32",   "transform": lambda x: x * 0.001 },
-    "bat3_invert_today":   { "address": 0x02FA, "type": "uint32",   "transform": lambda x: x * 0.001 },
-    "bat3_invert_week":    { "address": 0x02FC, "type": "uint32",   "transform": lambda x: x * 0.001 },
-    "bat3_invert_month":   { "address": 0x02FE, "type": "uint32",   "transform": lambda x: x * 0.001 },
-    "bat3_invert_year":    { "address": 0x0300, "type": "uint32",   "transform": lambda x: x * 0.001 },
-    "bat3_invert_total":   { "address": 0x0302, "type": "uint32",   "transform": lambda x: x * 0.001 },
-    "bat4_charge_hour":    { "address": 0x0310, "type": "uint32",   "transform": lambda x: x * 0.001 },
-    "bat4_charge_today":   { "address": 0x0312, "type": "uint32",   "transform": lambda x: x * 0.001 },
-    "bat4_charge_week":    { "address": 0x0314, "type": "uint32",   "transform": lambda x: x * 0.001 },
-    "bat4_charge_month":   { "address": 0x0316, "type": "uint32",   "transform": lambda x: x * 0.001 },
-    "bat4_charge_year":    { "address": 0x0318, "type": "uint32",   "transform": lambda x: x * 0.001 },
-    "bat4_charge_total":   { "address": 0x031A, "type": "uint32",   "transform": lambda x: x * 0.001 },
-    "bat4_invert_hour":    { "address": 0x0328, "type": "uint32",   "transform": lambda x: x * 0.001 },
-    "bat4_invert_today":   { "address": 0x032A, "type": "uint32",   "transform": lambda x: x * 0.001 },
-    "bat4_invert_week":    { "address": 0x032C, "type": "uint32",   "transform": lambda x: x * 0.001 },
-    "bat4_invert_month":   { "address": 0x032E, "type": "uint32",   "transform": lambda x: x * 0.001 },
-    "bat4_invert_year":    { "address": 0x0330, "type": "uint32",   "transform": lambda x: x * 0.001 },
-    "bat4_invert_total":   { "address": 0x0332, "type": "uint32",   "transform": lambda x: x * 0.001 },
-    "bat5_charge_hour":    { "address": 0x0340, "type": "uint32",   "transform": lambda x: x * 0.001 },
-    "bat5_charge_today":   { "address": 0x0342, "type": "uint32",   "transform": lambda x: x * 0.001 },
-    "bat5_charge_week":    { "address": 0x0344, "type": "uint32",   "transform": lambda x: x * 0.001 },
-    "bat5_charge_month":   { "address": 0x0346, "type": "uint32",   "transform": lambda x: x * 0.001 },
-    "bat5_charge_year":    { "address": 0x0348, "type": "uint32",   "transform": lambda x: x * 0.001 },
-    "bat5_charge_total":   { "address": 0x034A, "type": "uint32",   "transform": lambda x: x * 0.001 },
-    "bat5_invert_hour":    { "address": 0x0358, "type": "uint32",   "transform": lambda x: x * 0.001 },
-    "bat5_invert_today":   { "address": 0x035A, "type": "uint32",   "transform": lambda x: x * 0.001 },
-    "bat5_invert_week":    { "address": 0x035C, "type": "uint32",   "transform": lambda x: x * 0.001 },
-    "bat5_invert_month":   { "address": 0x035E, "type": "uint32",   "transform": lambda x: x * 0.001 },
-    "bat5_invert_year":    { "address": 0x0360, "type": "uint32",   "transform": lambda x: x * 0.001 },
-    "bat5_invert_total":   { "address": 0x0362, "type": "uint32",   "transform": lambda x: x * 0.001 },
-    "bat1_soc":            { "address": 0x03C8, "type": "uint32",   "transform": None }, # State of charge
-    "bat2_soc":            { "address": 0x03D2, "type": "uint32",   "transform": None },
-    "bat3_soc":            { "address": 0x03DC, "type": "uint32",   "transform": None },
-    "bat4_soc":            { "address": 0x03E6, "type": "uint32",   "transform": None },
-    "bat5_soc":            { "address": 0x03F0, "type": "uint32",   "transform": None },
-    "bat1_soh":            { "address": 0x041E, "type": "uint32",   "transform": None }, # State of health
-    "bat2_soh":            { "address": 0x0420, "type": "uint32",   "transform": None },
-    "bat3_soh":            { "address": 0x0422, "type": "uint32",   "transform": None },
-    "bat4_soh":            { "address": 0x0424, "type": "uint32",   "transform": None },
-    "bat5_soh":            { "address": 0x0426, "type": "uint32",   "transform": None },
+    "device_name":         { "address": 0x0000, "type": "string16", "refresh": "static", "transform": None }, # Not particularly useful information
+    "firmware_version":    { "address": 0x001E, "type": "string20", "refresh": "static", "transform": None }, 
+    "serial_number":       { "address": 0x002B, "type": "string16", "refresh": "static", "transform": None },
+    "utc_time":            { "address": 0x003A, "type": "uint32",   "refresh": "slow",   "transform": None }, # Has the time as UNIX (s)
+    "system_status":       { "address": 0x0040, "type": "uint16",   "refresh": "fast",   "transform": None }, # Unknown
+    "system_faults":       { "address": 0x0041, "type": "uint16",   "refresh": "fast",   "transform": None }, # Unknown
+    "generator_state":     { "address": 0x0042, "type": "uint16",   "refresh": "fast",   "transform": None }, # Unknown
+    "system_warnings":     { "address": 0x0043, "type": "uint16",   "refresh": "fast",   "transform": None }, # Unknown
+    "dc_input_today":      { "address": 0x00A4, "type": "uint32",   "refresh": "slow",   "transform": lambda x: x * 0.001 }, # Sum of bat*_invert_today
+    "dc_input_total":      { "address": 0x00B4, "type": "uint32",   "refresh": "slow",   "transform": lambda x: x * 0.001 }, # Sum of bat*_invert_total
+    "dc_output_today":     { "address": 0x00BC, "type": "uint32",   "refresh": "slow",   "transform": lambda x: x * 0.001 }, # Sum of bat*_charge_today
+    "dc_output_total":     { "address": 0x00CC, "type": "uint32",   "refresh": "slow",   "transform": lambda x: x * 0.001 }, # Sum of bat*_charge_total
+    "grid_input_today":    { "address": 0x00D4, "type": "uint32",   "refresh": "slow",   "transform": lambda x: x * 0.001 }, # Something (appears to be to the battery, slightly different from dc_output_today)
+    "grid_output_today":   { "address": 0x00EC, "type": "uint32",   "refresh": "slow",   "transform": lambda x: x * 0.001 }, # Something (appears to be from the battery to grid/house, slightly different from dc_input_today)
+    "battery_power_net":   { "address": 0x0158, "type": "int32",    "refresh": "fast",   "transform": lambda x: x * 0.001 }, # Negative = Powering Home, Position = Charging Battery, 0 = Nothing is happening
+    "bat1_charge_hour":    { "address": 0x0280, "type": "uint32",   "refresh": "slow",   "transform": lambda x: x * 0.001 },
+    "bat1_charge_today":   { "address": 0x0282, "type": "uint32",   "refresh": "slow",   "transform": lambda x: x * 0.001 },
+    "bat1_charge_week":    { "address": 0x0284, "type": "uint32",   "refresh": "slow",   "transform": lambda x: x * 0.001 },
+    "bat1_charge_month":   { "address": 0x0286, "type": "uint32",   "refresh": "slow",   "transform": lambda x: x * 0.001 },
+    "bat1_charge_year":    { "address": 0x0288, "type": "uint32",   "refresh": "slow",   "transform": lambda x: x * 0.001 },
+    "bat1_charge_total":   { "address": 0x028A, "type": "uint32",   "refresh": "slow",   "transform": lambda x: x * 0.001 },
+    "bat1_invert_hour":    { "address": 0x0298, "type": "uint32",   "refresh": "slow",   "transform": lambda x: x * 0.001 },
+    "bat1_invert_today":   { "address": 0x029A, "type": "uint32",   "refresh": "slow",   "transform": lambda x: x * 0.001 },
+    "bat1_invert_week":    { "address": 0x029C, "type": "uint32",   "refresh": "slow",   "transform": lambda x: x * 0.001 },
+    "bat1_invert_month":   { "address": 0x029E, "type": "uint32",   "refresh": "slow",   "transform": lambda x: x * 0.001 },
+    "bat1_invert_year":    { "address": 0x02A0, "type": "uint32",   "refresh": "slow",   "transform": lambda x: x * 0.001 },
+    "bat1_invert_total":   { "address": 0x02A2, "type": "uint32",   "refresh": "slow",   "transform": lambda x: x * 0.001 },
+    "bat2_charge_hour":    { "address": 0x02B0, "type": "uint32",   "refresh": "slow",   "transform": lambda x: x * 0.001 },
+    "bat2_charge_today":   { "address": 0x02B2, "type": "uint32",   "refresh": "slow",   "transform": lambda x: x * 0.001 },
+    "bat2_charge_week":    { "address": 0x02B4, "type": "uint32",   "refresh": "slow",   "transform": lambda x: x * 0.001 },
+    "bat2_charge_month":   { "address": 0x02B6, "type": "uint32",   "refresh": "slow",   "transform": lambda x: x * 0.001 },
+    "bat2_charge_year":    { "address": 0x02B8, "type": "uint32",   "refresh": "slow",   "transform": lambda x: x * 0.001 },
+    "bat2_charge_total":   { "address": 0x02BA, "type": "uint32",   "refresh": "slow",   "transform": lambda x: x * 0.001 },
+    "bat2_invert_hour":    { "address": 0x02C8, "type": "uint32",   "refresh": "slow",   "transform": lambda x: x * 0.001 },
+    "bat2_invert_today":   { "address": 0x02CA, "type": "uint32",   "refresh": "slow",   "transform": lambda x: x * 0.001 },
+    "bat2_invert_week":    { "address": 0x02CC, "type": "uint32",   "refresh": "slow",   "transform": lambda x: x * 0.001 },
+    "bat2_invert_month":   { "address": 0x02CE, "type": "uint32",   "refresh": "slow",   "transform": lambda x: x * 0.001 },
+    "bat2_invert_year":    { "address": 0x02C0, "type": "uint32",   "refresh": "slow",   "transform": lambda x: x * 0.001 },
+    "bat2_invert_total":   { "address": 0x02C2, "type": "uint32",   "refresh": "slow",   "transform": lambda x: x * 0.001 },
+    "bat3_charge_hour":    { "address": 0x02E0, "type": "uint32",   "refresh": "slow",   "transform": lambda x: x * 0.001 },
+    "bat3_charge_today":   { "address": 0x02E2, "type": "uint32",   "refresh": "slow",   "transform": lambda x: x * 0.001 },
+    "bat3_charge_week":    { "address": 0x02E4, "type": "uint32",   "refresh": "slow",   "transform": lambda x: x * 0.001 },
+    "bat3_charge_month":   { "address": 0x02E6, "type": "uint32",   "refresh": "slow",   "transform": lambda x: x * 0.001 },
+    "bat3_charge_year":    { "address": 0x02E8, "type": "uint32",   "refresh": "slow",   "transform": lambda x: x * 0.001 },
+    "bat3_charge_total":   { "address": 0x02EA, "type": "uint32",   "refresh": "slow",   "transform": lambda x: x * 0.001 },
+    "bat3_invert_hour":    { "address": 0x02F8, "type": "uint32",   "refresh": "slow",   "transform": lambda x: x * 0.001 },
+    "bat3_invert_today":   { "address": 0x02FA, "type": "uint32",   "refresh": "slow",   "transform": lambda x: x * 0.001 },
+    "bat3_invert_week":    { "address": 0x02FC, "type": "uint32",   "refresh": "slow",   "transform": lambda x: x * 0.001 },
+    "bat3_invert_month":   { "address": 0x02FE, "type": "uint32",   "refresh": "slow",   "transform": lambda x: x * 0.001 },
+    "bat3_invert_year":    { "address": 0x0300, "type": "uint32",   "refresh": "slow",   "transform": lambda x: x * 0.001 },
+    "bat3_invert_total":   { "address": 0x0302, "type": "uint32",   "refresh": "slow",   "transform": lambda x: x * 0.001 },
+    "bat4_charge_hour":    { "address": 0x0310, "type": "uint32",   "refresh": "slow",   "transform": lambda x: x * 0.001 },
+    "bat4_charge_today":   { "address": 0x0312, "type": "uint32",   "refresh": "slow",   "transform": lambda x: x * 0.001 },
+    "bat4_charge_week":    { "address": 0x0314, "type": "uint32",   "refresh": "slow",   "transform": lambda x: x * 0.001 },
+    "bat4_charge_month":   { "address": 0x0316, "type": "uint32",   "refresh": "slow",   "transform": lambda x: x * 0.001 },
+    "bat4_charge_year":    { "address": 0x0318, "type": "uint32",   "refresh": "slow",   "transform": lambda x: x * 0.001 },
+    "bat4_charge_total":   { "address": 0x031A, "type": "uint32",   "refresh": "slow",   "transform": lambda x: x * 0.001 },
+    "bat4_invert_hour":    { "address": 0x0328, "type": "uint32",   "refresh": "slow",   "transform": lambda x: x * 0.001 },
+    "bat4_invert_today":   { "address": 0x032A, "type": "uint32",   "refresh": "slow",   "transform": lambda x: x * 0.001 },
+    "bat4_invert_week":    { "address": 0x032C, "type": "uint32",   "refresh": "slow",   "transform": lambda x: x * 0.001 },
+    "bat4_invert_month":   { "address": 0x032E, "type": "uint32",   "refresh": "slow",   "transform": lambda x: x * 0.001 },
+    "bat4_invert_year":    { "address": 0x0330, "type": "uint32",   "refresh": "slow",   "transform": lambda x: x * 0.001 },
+    "bat4_invert_total":   { "address": 0x0332, "type": "uint32",   "refresh": "slow",   "transform": lambda x: x * 0.001 },
+    "bat5_charge_hour":    { "address": 0x0340, "type": "uint32",   "refresh": "slow",   "transform": lambda x: x * 0.001 },
+    "bat5_charge_today":   { "address": 0x0342, "type": "uint32",   "refresh": "slow",   "transform": lambda x: x * 0.001 },
+    "bat5_charge_week":    { "address": 0x0344, "type": "uint32",   "refresh": "slow",   "transform": lambda x: x * 0.001 },
+    "bat5_charge_month":   { "address": 0x0346, "type": "uint32",   "refresh": "slow",   "transform": lambda x: x * 0.001 },
+    "bat5_charge_year":    { "address": 0x0348, "type": "uint32",   "refresh": "slow",   "transform": lambda x: x * 0.001 },
+    "bat5_charge_total":   { "address": 0x034A, "type": "uint32",   "refresh": "slow",   "transform": lambda x: x * 0.001 },
+    "bat5_invert_hour":    { "address": 0x0358, "type": "uint32",   "refresh": "slow",   "transform": lambda x: x * 0.001 },
+    "bat5_invert_today":   { "address": 0x035A, "type": "uint32",   "refresh": "slow",   "transform": lambda x: x * 0.001 },
+    "bat5_invert_week":    { "address": 0x035C, "type": "uint32",   "refresh": "slow",   "transform": lambda x: x * 0.001 },
+    "bat5_invert_month":   { "address": 0x035E, "type": "uint32",   "refresh": "slow",   "transform": lambda x: x * 0.001 },
+    "bat5_invert_year":    { "address": 0x0360, "type": "uint32",   "refresh": "slow",   "transform": lambda x: x * 0.001 },
+    "bat5_invert_total":   { "address": 0x0362, "type": "uint32",   "refresh": "slow",   "transform": lambda x: x * 0.001 },
+    "bat1_soc":            { "address": 0x03C8, "type": "uint32",   "refresh": "fast",   "transform": None }, # State of charge
+    "bat2_soc":            { "address": 0x03D2, "type": "uint32",   "refresh": "fast",   "transform": None },
+    "bat3_soc":            { "address": 0x03DC, "type": "uint32",   "refresh": "fast",   "transform": None },
+    "bat4_soc":            { "address": 0x03E6, "type": "uint32",   "refresh": "fast",   "transform": None },
+    "bat5_soc":            { "address": 0x03F0, "type": "uint32",   "refresh": "fast",   "transform": None },
+    "bat1_soh":            { "address": 0x041E, "type": "uint32",   "refresh": "slow",   "transform": None }, # State of health
+    "bat2_soh":            { "address": 0x0420, "type": "uint32",   "refresh": "slow",   "transform": None },
+    "bat3_soh":            { "address": 0x0422, "type": "uint32",   "refresh": "slow",   "transform": None },
+    "bat4_soh":            { "address": 0x0424, "type": "uint32",   "refresh": "slow",   "transform": None },
+    "bat5_soh":            { "address": 0x0426, "type": "uint32",   "refresh": "slow",   "transform": None },
 }
 
 # List of base registers to read from the ESS.
 ESS_BASE_REGISTERS = [
+    "firmware_version",
+    "serial_number",
+    "system_status",
+    "system_faults",
+    "system_warnings",
     "dc_input_total",
     "dc_output_total",
     "battery_power_net",
@@ -289,211 +552,932 @@ ESS_BATTERY_REGISTERS = [
     "bat%d_soh",
 ]
 
-ESS_REGISTERS_TO_READ = [] + ESS_BASE_REGISTERS
+# Registers to read from the ESS for the given number of batteries.
+def ess_registers_to_read(battery_count):
+    registers = [] + ESS_BASE_REGISTERS
+    for battery in range(battery_count):
+        for register in ESS_BATTERY_REGISTERS:
+            registers.append(register % (battery+1))
+    return registers
+
+
+# Returns a section of the config for a site, the keys of [<section>.<site name>] override the keys of [<section>].
+def site_section(section, name):
+    settings = dict(config[section]) if config.has_section(section) else {}
+    if name != "" and config.has_section(f"{section}.{name}"):
+        settings.update(config[f"{section}.{name}"])
+    site_config = configparser.ConfigParser(interpolation=None)
+    site_config.read_dict({ section: settings })
+    return site_config[section]
 
-for battery in range(ESS_BATTERY_COUNT):
-    for register in ESS_BATTERY_REGISTERS:
-        ESS_REGISTERS_TO_READ.append(register % (battery+1))
 
-PVS_DATA = {}
-ESS_DATA = {}
-PVS_DATA_VALID = False
-ESS_DATA_SAMPLED = False
-ESS_DATA_VALID = not ESS_ENABLED
+# A PVS and its optional ESS along with everything sampled from them. Every site has its own settings, data, plans,
+# rollups, history and MQTT state so any number of sites can be polled side by side. A named site reads its
+# settings from [pvs.<name>] and [ess.<name>] and publishes under <topic_prefix>/<name>, the unnamed site used
+# when no sites are configured reads [pvs] and [ess] and publishes under <topic_prefix>.
+class Site:
+    def __init__(self, name=""):
+        pvs = site_section("pvs", name)
+        ess = site_section("ess", name)
+        self.name = name
+        self.topic_prefix = f"{MQTT_TOPIC_PREFIX}/{name}" if name != "" else MQTT_TOPIC_PREFIX
+        self.unique_prefix = f"{MQTT_TOPIC_PREFIX}_{name}" if name != "" else MQTT_TOPIC_PREFIX
+        self.labels = { "site": name } if name != "" else {}
+
+        self.pvs_sample_period = pvs.getfloat("sample_period", fallback=300)
+        self.pvs_host = pvs.get("host", fallback="192.168.1.13")
+        self.pvs_connect_timeout = pvs.getfloat("connect_timeout", fallback=10)
+        self.pvs_read_timeout = pvs.getfloat("read_timeout", fallback=120)
+        self.pvs_url = f"http://{self.pvs_host}/cgi-bin/dl_cgi?Command=DeviceList"
+
+        self.ess_enabled = ess.getboolean("enabled", fallback=False)
+        self.ess_sample_period = ess.getfloat("sample_period", fallback=60)
+        self.ess_host = ess.get("host", fallback="")
+        self.ess_port = ess.getint("port", fallback=503)
+        self.ess_unit_id = ess.getint("unit_id", fallback=1)
+        self.ess_timeout = ess.getint("timeout", fallback=30)
+        self.ess_interface = ess.get("interface", fallback="eth0")
+        self.ess_subnet = ess.get("subnet", fallback="")
+        self.ess_rescan_failures = ess.getint("rescan_failures", fallback=3)
+        self.ess_host_cache_path = os.path.join(os.path.dirname(config_path), ess.get("host_cache", fallback=f"ess_host.{name}.cache" if name != "" else "ess_host.cache"))
+        self.ess_slow_sample_period = ess.getfloat("slow_sample_period", fallback=300)
+        self.ess_fast_sample_period = ess.getfloat("fast_sample_period", fallback=10)
+        self.ess_fast_power_delta = ess.getfloat("fast_power_delta", fallback=0.5)
+        self.ess_battery_count = ess.getint("battery_count", fallback=1)
+        self.ess_read_gap = ess.getint("read_gap", fallback=32)
+        self.ess_registers_to_read = ess_registers_to_read(self.ess_battery_count)
+        self.ess_registers_by_refresh = { "static": [], "slow": [], "fast": [] }
+        for register in self.ess_registers_to_read:
+            self.ess_registers_by_refresh[ESS_REGISTERS[register]["refresh"]].append(register)
+
+        self.pvs_data = {}
+        # DeviceInfo of every device in pvs_data, keyed by device key.
+        self.devices = {}
+        self.ess_data = {}
+        self.pvs_data_valid = False
+        self.ess_data_sampled = False
+        self.ess_data_valid = not self.ess_enabled
+        # Resolved ESS plans of the devices that have ESS fields as (device type, device data, plan), keyed by device key.
+        # Battery register names are resolved when the device first appears.
+        self.ess_device_plans = {}
+        self.ess_derived_plans = {}
+        self.rollups = { device_type: DeviceTypeRollup(device_type, fields, self.pvs_data) for device_type, fields in ROLLUP_FIELDS.items() }
+        # History series keyed by (device key, field).
+        self.history = {}
+
+        self.pvs_session = None
+        self.pvs_last_digest = None
+        self.pvs_device_keys = []
+
+        self.ess_modbus = None
+        # Consecutive samples that could not be read.
+        self.ess_failures = 0
+        self.ess_power_delta = 0
+        self.ess_sample_time = 0
+        # Time each refresh class was last read completely, fast registers are read on every sample.
+        self.ess_refresh_time = { "static": None, "slow": None }
+        # Read plans keyed by the refresh classes that are due.
+        self.ess_read_plans = {}
+
+        # Home Assistant discovery config that has been published, keyed by device key. Each entry holds the model,
+        # name and serial number the config was built from and the fields already published.
+        self.homeassistant_config_cache = {}
+        # Last published state per device key as (publish time, DeviceState snapshot).
+        self.mqtt_last_state = {}
+        self.api_snapshot = ApiSnapshot()
+        # Dynamic field values (without last_sample_time) of every device as last exported, keyed by device key.
+        self.export_last_values = {}
+
+    def task_name(self, task):
+        return f"{self.name}/{task}" if self.name != "" else task
 
 
 def make_device_key(device_type, serial_number):
     return f"{device_type}-{serial_number}"
 
 
-def split_device_key(device_key):
-    tokens = device_key.split("-")
-    return tokens[0], tokens[1]
+# Field extraction plans compiled once from PVS_METADATA for each device type. Every plan is a tuple of
+# (raw name, field, transform) entries, pvs holds the fields read from the DeviceList response, ess the fields read
+# from the ESS data (battery registers still contain %d) and derived the ess fields computed only by their transform
+# (which is given the site).
+def compile_pvs_plans(metadata):
+    plans = {}
+    for device_type, device_metadata in metadata.items():
+        plan = { "pvs": [], "ess": [], "derived": [] }
+        for field, field_metadata in device_metadata['fields'].items():
+            raw_name = field_metadata['raw_name']
+            if field_metadata['source'] == "pvs" and raw_name != "":
+                plan["pvs"].append((raw_name, field, field_metadata['transform']))
+            elif field_metadata['source'] == "ess":
+                plan["ess" if raw_name != "" else "derived"].append((raw_name, field, field_metadata['transform']))
+        plans[device_type] = { source: tuple(entries) for source, entries in plan.items() }
+    return plans
+
+
+PVS_PLANS = compile_pvs_plans(PVS_METADATA)
+
+MISSING = object()
+
+
+# State of a single device. A subclass with a slot per field is generated for every device type in PVS_METADATA
+# (see make_device_state_class) and used like a dict, fields that were never set hold MISSING and are absent. The
+# sampling loops assign the slots directly with setattr. The static fields are encoded to a JSON fragment once and
+# reused until one of their values changes, so publishing only encodes the others.
+class DeviceState:
+    __slots__ = ("_static_values", "_static_json")
+    DEVICE_TYPE = ""
+    FIELDS = ()
+    FIELD_SET = frozenset()
+    STATIC_FIELDS = ()
+    DYNAMIC_FIELDS = ()
+
+    def __init__(self):
+        for field in self.FIELDS:
+            setattr(self, field, MISSING)
+        self._static_values = None
+        self._static_json = ""
+
+    def __getitem__(self, field):
+        value = getattr(self, field) if field in self.FIELD_SET else MISSING
+        if value is MISSING:
+            raise KeyError(field)
+        return value
+
+    def __setitem__(self, field, value):
+        if field not in self.FIELD_SET:
+            raise KeyError(field)
+        setattr(self, field, value)
+
+    def __contains__(self, field):
+        return field in self.FIELD_SET and getattr(self, field) is not MISSING
+
+    def __iter__(self):
+        return (field for field in self.FIELDS if getattr(self, field) is not MISSING)
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+    def keys(self):
+        return list(self)
+
+    def items(self):
+        return [(field, getattr(self, field)) for field in self]
+
+    def get(self, field, default=None):
+        value = getattr(self, field) if field in self.FIELD_SET else MISSING
+        return default if value is MISSING else value
+
+    def update(self, data):
+        for field, value in data.items():
+            self[field] = value
+
+    # Values of every field in FIELDS order (MISSING when not set), used to detect changes between publishes.
+    def snapshot(self):
+        return self.get_fields(self)
+
+    # Encodes the fields that are set as a JSON object.
+    @staticmethod
+    def _fields_json(fields, values):
+        if MISSING in values:
+            return JSON_ENCODE({ field: value for field, value in zip(fields, values) if value is not MISSING })
+        return JSON_ENCODE(dict(zip(fields, values)))
+
+    def to_json(self):
+        static_values = self.get_static_fields(self)
+        if static_values != self._static_values:
+            self._static_values = static_values
+            self._static_json = self._fields_json(self.STATIC_FIELDS, static_values)[1:-1]
+        dynamic_json = self._fields_json(self.DYNAMIC_FIELDS, self.get_dynamic_fields(self))[1:-1]
+        return "{" + self._static_json + (", " if self._static_json != "" and dynamic_json != "" else "") + dynamic_json + "}"
+
+
+# json.dumps with arguments builds a new encoder on every call, device states reuse a single one with the same
+# output as json.dumps.
+JSON_ENCODE = json.JSONEncoder(separators=(", ", ": ")).encode
+
+
+DEVICE_STATIC_FIELDS = ("model", "serial_number", "hardware_version", "software_version", "firmware_version")
+
+
+# Returns a function reading the given attributes of an object as a tuple, attrgetter only returns a tuple for two
+# or more names.
+def attributes_getter(names):
+    if len(names) >= 2:
+        return operator.attrgetter(*names)
+    return lambda item: tuple(getattr(item, name) for name in names)
+
+
+def make_device_state_class(device_type, device_metadata):
+    fields = tuple(["last_sample_time", "available"] + list(device_metadata['fields']) + device_metadata.get('extra_fields', []))
+    static_fields = tuple(field for field in fields if field in DEVICE_STATIC_FIELDS)
+    dynamic_fields = tuple(field for field in fields if field not in static_fields)
+    return type(f"{device_type.title().replace('_', '')}State", (DeviceState,), {
+        "__slots__": fields,
+        "DEVICE_TYPE": device_type,
+        "FIELDS": fields,
+        "FIELD_SET": frozenset(fields),
+        "STATIC_FIELDS": static_fields,
+        "DYNAMIC_FIELDS": dynamic_fields,
+        "get_fields": staticmethod(attributes_getter(fields)),
+        "get_static_fields": staticmethod(attributes_getter(static_fields)),
+        "get_dynamic_fields": staticmethod(attributes_getter(dynamic_fields)),
+    })
+
+
+DEVICE_STATE_CLASSES = { device_type: make_device_state_class(device_type, device_metadata) for device_type, device_metadata in PVS_METADATA.items() }
+
+
+# Device types whose ESS fields are read from per battery registers (the register names contain %d).
+ESS_BATTERY_DEVICE_TYPES = frozenset(device_type for device_type, plans in PVS_PLANS.items() if any("%d" in raw_name for raw_name, _, _ in plans["ess"]))
+
+
+# Identity of a device, resolved once when the device first appears. key is the interned device key the device data
+# is stored and published under, battery_index the number of the battery whose registers hold its ESS fields (0 for
+# devices that are not batteries) and display_name the device name shown in Home Assistant.
+class DeviceInfo:
+    __slots__ = ("key", "device_type", "serial_number", "metadata", "battery_index", "display_name")
+
+    def __init__(self, key, device_type, serial_number, metadata, battery_index, display_name):
+        self.key = key
+        self.device_type = device_type
+        self.serial_number = serial_number
+        self.metadata = metadata
+        self.battery_index = battery_index
+        self.display_name = display_name
 
 
-def manual_average(data, target_device, field):
-    values = []
-    for device_key in data:
-        device_type, _ = split_device_key(device_key)
-        if device_type == target_device:
-            values.append(data[device_key][field])
-    return sum(values) / len(values)
+# Adds a device to the site's registry. Batteries are numbered in the order they appear, the serial number in the
+# display name is replaced through serial_to_id. key defaults to the device key of the type and serial number.
+def device_register(site, device_type, serial_number, key=None):
+    key = sys.intern(make_device_key(device_type, serial_number) if key is None else key)
+    battery_index = 0
+    if device_type in ESS_BATTERY_DEVICE_TYPES:
+        battery_index = sum(1 for info in site.devices.values() if info.battery_index > 0) + 1
+    id = serial_number.lower()
+    if SERIAL_TO_ID_ENABLED and id in SERIAL_TO_ID_MAP:
+        id = SERIAL_TO_ID_MAP[id]
+    metadata = PVS_METADATA[device_type]
+    info = site.devices[key] = DeviceInfo(key, device_type, serial_number, metadata, battery_index, f"{metadata['name']} {id}".strip())
+    return info
 
 
-def pvs_process_response(response):
-    global PVS_DATA
+def ess_register_device(site, info):
+    plans = PVS_PLANS[info.device_type]
+    if len(plans["ess"]) > 0:
+        plan = tuple((raw_name % info.battery_index if "%d" in raw_name else raw_name, field, transform) for raw_name, field, transform in plans["ess"])
+        site.ess_device_plans[info.key] = (info.device_type, site.pvs_data[info.key], plan)
+    if len(plans["derived"]) > 0:
+        site.ess_derived_plans[info.key] = (info.device_type, site.pvs_data[info.key], plans["derived"])
+
+
+# Numeric fields of every device of one device type kept in contiguous arrays indexed by device slot, so site wide
+# statistics are computed over the arrays instead of walking the site data. Missing values are stored as NaN.
+class DeviceTypeRollup:
+    def __init__(self, device_type, fields, devices):
+        self.device_type = device_type
+        self.fields = fields
+        self.devices = devices
+        self.slots = {}
+        self.device_keys = []
+        self.columns = { field: array("d") for field in fields }
+        self.missing = { field: 0 for field in fields }
+
+    def update(self, device_key, data):
+        index = self.slots.get(device_key)
+        if index is None:
+            index = self.slots[device_key] = len(self.device_keys)
+            self.device_keys.append(device_key)
+            for field in self.fields:
+                self.columns[field].append(math.nan)
+                self.missing[field] += 1
+        for field in self.fields:
+            value = getattr(data, field)
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                continue
+            column = self.columns[field]
+            if column[index] != column[index]:
+                self.missing[field] -= 1
+            column[index] = value
+
+    def values(self, field):
+        column = self.columns[field]
+        return column if self.missing[field] == 0 else [value for value in column if value == value]
+
+    def mean(self, field):
+        values = self.values(field)
+        return sum(values) / len(values) if len(values) > 0 else None
+
+    def statistics(self):
+        data = { "devices": len(self.device_keys) }
+        for field, statistics in self.fields.items():
+            values = self.values(field)
+            if len(values) == 0:
+                continue
+            total = math.fsum(values)
+            mean = total / len(values)
+            results = { "total": total, "min": min(values), "max": max(values), "mean": mean }
+            for statistic in statistics:
+                if statistic == "outliers":
+                    column = self.columns[field]
+                    limit = mean * (1 - ROLLUP_OUTLIER_THRESHOLD)
+                    outliers = [self.devices[self.device_keys[index]]['serial_number'] for index in range(len(column)) if column[index] < limit] if mean > 0 else []
+                    data[f"{field}_outliers"] = len(outliers)
+                    data[f"{field}_outliers_list"] = outliers
+                else:
+                    data[f"{field}_{statistic}"] = results[statistic]
+        return data
+
+
+# Writes the statistics of every rollup into the data of its virtual site device.
+def rollup_publish(site, sample_time):
+    if not ROLLUP_PUBLISH:
+        return
+    for device_type, rollup in site.rollups.items():
+        if len(rollup.device_keys) == 0:
+            continue
+        device_key = make_device_key(f"site_{device_type}", "site")
+        data = site.pvs_data.get(device_key)
+        if data is None:
+            info = device_register(site, f"site_{device_type}", "", device_key)
+            data = site.pvs_data[info.key] = DEVICE_STATE_CLASSES[info.device_type]()
+            data.update({ "model": "Site Rollup", "serial_number": "" })
+        data.update(rollup.statistics())
+        data['last_sample_time'] = max(data.get('last_sample_time', 0), sample_time)
+
+
+def pvs_device_type(device):
+    return get_safe_name(device['DEVICE_TYPE']).replace("+", "plus")
+
+
+# Raw DeviceList keys needed by each device type, everything else is dropped while parsing.
+PVS_RAW_KEYS = { device_type: frozenset(["DEVICE_TYPE", "SERIAL"] + [raw_name for raw_name, _, _ in plans["pvs"]]) for device_type, plans in PVS_PLANS.items() }
+
+
+# Incremental parser for the DeviceList response. Chunks of the body are fed as they arrive and every element of
+# the devices array is returned as soon as it is complete, reduced to the raw keys its device type needs.
+class PvsDeviceListParser:
+    DEVICES_START = re.compile(r'"devices"\s*:\s*\[')
+
+    def __init__(self):
+        self.decoder = json.JSONDecoder()
+        self.text_decoder = codecs.getincrementaldecoder("utf-8")()
+        self.buffer = ""
+        self.in_devices = False
+        self.done = False
+
+    def feed(self, chunk, final=False):
+        self.buffer += self.text_decoder.decode(chunk, final)
+        devices = []
+        position = 0
+        if not self.in_devices and not self.done:
+            match = self.DEVICES_START.search(self.buffer)
+            if match is None:
+                if final:
+                    raise ValueError("DeviceList response has no devices")
+                return devices
+            self.in_devices = True
+            position = match.end()
+        while self.in_devices:
+            while position < len(self.buffer) and self.buffer[position] in " \t\r\n,":
+                position += 1
+            if position == len(self.buffer):
+                break
+            if self.buffer[position] == "]":
+                self.in_devices = False
+                self.done = True
+                break
+            try:
+                device, position = self.decoder.raw_decode(self.buffer, position)
+            except json.JSONDecodeError:
+                if final:
+                    raise
+                break
+            raw_keys = PVS_RAW_KEYS.get(pvs_device_type(device))
+            if raw_keys is not None:
+                device = { key: value for key, value in device.items() if key in raw_keys }
+            devices.append(device)
+        self.buffer = "" if self.done else self.buffer[position:]
+        if final and not self.done:
+            raise ValueError("DeviceList response is incomplete")
+        return devices
+
+
+@timed("sunpower_pvs_process_seconds")
+def pvs_process_response(site, response, sample_time=None):
+    sample_time = time.time() if sample_time is None else sample_time
+    device_keys = []
     for device in response['devices']:
-        device_type = get_safe_name(device['DEVICE_TYPE'])
-        device_type = device_type.replace("+", "plus")
+        device_type = pvs_device_type(device)
         serial_number = device['SERIAL']
         device_key = make_device_key(device_type, serial_number)
-        if device_key not in PVS_DATA:
-            PVS_DATA[device_key] = {}
-        PVS_DATA[device_key]['last_sample_time'] = time.time()
-        for field in PVS_METADATA[device_type]['fields']:
-            field_metadata = PVS_METADATA[device_type]['fields'][field]
-            if field_metadata['source'] == "pvs" and field_metadata['raw_name'] != "" and field_metadata['raw_name'] in device:
-                value = device[field_metadata['raw_name']]
-                if field_metadata['transform'] is not None:
-                    value = field_metadata['transform'](value)
-                PVS_DATA[device_key][field] = value
-
-
-async def pvs_sample():
-    global PVS_DATA_VALID
-    target_time = time.time() + PVS_SAMPLE_PERIOD
-    while True:
-        async with aiohttp.ClientSession() as session:
-            async with session.get("http://192.168.1.13/cgi-bin/dl_cgi?Command=DeviceList", timeout=120) as response:
-                pvs_process_response(await response.json())
-                PVS_DATA_VALID = True
-                merge_ess_into_pvs()
-        sleep_time = target_time - time.time()
-        await asyncio.sleep(sleep_time)
-        target_time += PVS_SAMPLE_PERIOD
-
-
-def ess_determine_subnet():
-    addr = netifaces.ifaddresses('eth0')[netifaces.AF_INET][0]
+        data = site.pvs_data.get(device_key)
+        if data is None:
+            info = device_register(site, device_type, serial_number)
+            device_key = info.key
+            data = site.pvs_data[device_key] = DEVICE_STATE_CLASSES[device_type]()
+            ess_register_device(site, info)
+        data.last_sample_time = sample_time
+        device_keys.append(device_key)
+        for raw_name, field, transform in PVS_PLANS[device_type]["pvs"]:
+            if raw_name in device:
+                value = device[raw_name]
+                setattr(data, field, value if transform is None else transform(value))
+        if HISTORY_ENABLED:
+            history_record(site, device_key, data, HISTORY_PLANS[device_type]["pvs"], sample_time)
+        if device_type in site.rollups:
+            site.rollups[device_type].update(device_key, data)
+    rollup_publish(site, sample_time)
+    return device_keys
+
+
+# Marks the devices of a response as sampled without processing it again, used when the response is unchanged.
+def pvs_refresh_sample_time(site, device_keys, sample_time):
+    for device_key in device_keys:
+        site.pvs_data[device_key]['last_sample_time'] = sample_time
+
+
+@timed("sunpower_pvs_sample_seconds")
+async def pvs_sample(site):
+    if site.pvs_session is None:
+        import aiohttp
+        timeout = aiohttp.ClientTimeout(sock_connect=site.pvs_connect_timeout, sock_read=site.pvs_read_timeout)
+        connector = aiohttp.TCPConnector(limit=1, keepalive_timeout=site.pvs_sample_period * 2)
+        site.pvs_session = aiohttp.ClientSession(timeout=timeout, connector=connector)
+    parser = PvsDeviceListParser()
+    body_hash = hashlib.blake2b(digest_size=16)
+    devices = []
+    body = []
+    async with site.pvs_session.get(site.pvs_url) as response:
+        response.raise_for_status()
+        async for chunk in response.content.iter_any():
+            body_hash.update(chunk)
+            METRICS.inc("sunpower_pvs_bytes_total", len(chunk), **site.labels)
+            devices += parser.feed(chunk)
+            if CAPTURE is not None:
+                body.append(chunk)
+    devices += parser.feed(b"", final=True)
+    digest = body_hash.digest()
+    sample_time = time.time()
+    METRICS.set("sunpower_pvs_devices", len(devices), **site.labels)
+    if CAPTURE is not None:
+        CAPTURE.append(Capture.PVS, site, sample_time, b"" if digest == site.pvs_last_digest else b"".join(body))
+    pvs_apply_sample(site, devices, digest, sample_time)
+
+
+# Processes the devices of a DeviceList response, a response identical to the previous one (same digest) only
+# refreshes the sample times.
+def pvs_apply_sample(site, devices, digest, sample_time):
+    if digest == site.pvs_last_digest:
+        METRICS.inc("sunpower_pvs_unchanged_total", **site.labels)
+        pvs_refresh_sample_time(site, site.pvs_device_keys, sample_time)
+    else:
+        site.pvs_device_keys = pvs_process_response(site, { "devices": devices }, sample_time)
+        site.pvs_last_digest = digest
+        if not site.pvs_data_valid:
+            site.pvs_data_valid = True
+            mqtt_request_publish()
+        merge_ess_into_pvs(site)
+    sample_processed(site, sample_time)
+
+
+def ess_determine_subnet(site):
+    if site.ess_subnet != "":
+        return site.ess_subnet
+    import netifaces
+    addr = netifaces.ifaddresses(site.ess_interface)[netifaces.AF_INET][0]
     ip = addr['addr']
     cidr = IPv4Network('0.0.0.0/' + addr['netmask']).prefixlen
     return str(ip) + "/" + str(cidr)
 
 
-def ess_find_host(modbusPort):
-    nm = nmap.PortScanner()
-    args = "-p " + str(modbusPort) + " -sT"
-    nm.scan(hosts=ess_determine_subnet(), arguments=args)
-    for host in nm.all_hosts():
-        for proto in nm[host].all_protocols():
-            if proto == "tcp":
-                for port in nm[host][proto].keys():
-                    if port == modbusPort and nm[host][proto][port]['state'] == 'open':
-                        print(f"host is {host}")
-                        return host
+async def ess_probe_host(host, port):
+    try:
+        _, writer = await asyncio.wait_for(asyncio.open_connection(host, port), ESS_SCAN_TIMEOUT)
+    except (OSError, asyncio.TimeoutError):
+        return False
+    writer.close()
+    try:
+        await writer.wait_closed()
+    except OSError:
+        pass
+    return True
+
+
+# Checks a host with an open modbus port answers the ESS serial number register with a non-empty value. This rejects
+# hosts that only accept the connection or answer with modbus exceptions, another modbus device that happens to hold
+# text at the same unit id and address would still pass.
+async def ess_verify_host(site, host, port):
+    if not ESS_SCAN_VERIFY:
+        return True
+    modbus = EssModbus(host, port, site.ess_unit_id, ESS_SCAN_TIMEOUT)
+    try:
+        data = await ess_read_registers(modbus, ess_plan_reads(["serial_number"], site.ess_read_gap))
+    except (ValueError, OSError) as e:
+        print(f"{host} is not an ESS ({e!r})")
+        return False
+    finally:
+        modbus.close()
+    return data.get("serial_number", "").strip("\x00 \ufffd") != ""
+
+
+# Connects to the modbus port of every host in the subnet and returns the first host that answers and passes
+# verification. scan_concurrency workers share one iterator over the hosts so a large subnet never creates more
+# tasks than that.
+async def ess_scan_subnet(site, subnet, port):
+    hosts = (str(host) for host in IPv4Network(subnet, strict=False).hosts())
+
+    async def worker():
+        for host in hosts:
+            if await ess_probe_host(host, port) and await ess_verify_host(site, host, port):
+                return host
+        return None
+
+    pending = { asyncio.create_task(worker()) for _ in range(ESS_SCAN_CONCURRENCY) }
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.result() is not None:
+                    return task.result()
+    finally:
+        for task in pending:
+            task.cancel()
     return None
 
 
-def ess_read_register(modbus, register):
-    def to_uint(values):
-        if values is None:
-            print(f"{register['address']} is None")
-        sum = 0
-        for v in values:
-            sum = (sum << 16) + v
-        if register["transform"] is not None:
-            sum = register["transform"](sum)
-        return sum
+# Returns the ESS host, trying the host found by the previous scan before scanning the subnet again.
+async def ess_find_host(site, port):
+    if os.path.exists(site.ess_host_cache_path):
+        with open(site.ess_host_cache_path) as file:
+            host = file.read().strip()
+        if host != "" and await ess_probe_host(host, port) and await ess_verify_host(site, host, port):
+            print(f"host is {host} (cached)")
+            return host
+    host = await ess_scan_subnet(site, ess_determine_subnet(site), port)
+    if host is not None:
+        print(f"host is {host}")
+        with open(site.ess_host_cache_path, "w") as file:
+            file.write(host)
+    return host
 
-    def to_int(values):
-        if values is None:
-            print(f"{register['address']} is None")
-        sum = 0
-        for v in values:
-            sum = (sum << 16) + v
-        if sum & (1 << (len(values)*16) - 1) > 0:
-            sum = sum - (1 << len(values)*16)
-        if register["transform"] is not None:
-            sum = register["transform"](sum)
-        return sum
-    
-    def to_string(values):
-        if values is None:
-            print(f"{register['address']} is None")
-        sum = b''
-        for v in values:
-            sum += v.to_bytes(2, 'big')
-        text = sum.decode('utf-8')
-        if register["transform"] is not None:
-            text = register["transform"](text)
-        return text
 
+def ess_register_size(register):
     if register["type"].startswith("string"):
-        registers = int(register["type"].replace("string", "")) / 2
-        return to_string(modbus.read_holding_registers(register["address"], registers))
-    elif register["type"] == "uint32":
-        return to_uint(modbus.read_holding_registers(register["address"], 2))
-    elif register["type"] == "int32":
-        return to_int(modbus.read_holding_registers(register["address"], 2))
-    elif register["type"] == "int16":
-        return to_int(modbus.read_holding_registers(register["address"], 1))
-    elif register["type"] == "uint16":
-        return to_uint(modbus.read_holding_registers(register["address"], 1))
+        return int(register["type"].replace("string", "")) // 2
+    elif register["type"] in ("uint32", "int32"):
+        return 2
+    elif register["type"] in ("uint16", "int16"):
+        return 1
     else:
         raise ValueError(f"Unknown register type {register['type']}")
 
 
-async def ess_read_registers(modbus, registers):
-    data = {}
-    for register_name in registers:
+def ess_decode_register(register, values):
+    if register["type"].startswith("string"):
+        text = b''.join(v.to_bytes(2, 'big') for v in values).decode('utf-8', errors='replace')
+        if register["transform"] is not None:
+            text = register["transform"](text)
+        return text
+    sum = 0
+    for v in values:
+        sum = (sum << 16) + v
+    if register["type"].startswith("int") and sum & (1 << (len(values)*16) - 1) > 0:
+        sum = sum - (1 << len(values)*16)
+    if register["transform"] is not None:
+        sum = register["transform"](sum)
+    return sum
+
+
+# Groups the requested registers into contiguous address ranges so each range can be fetched with a single
+# request. Registers are merged into the same range when the hole between them is at most max_gap registers
+# and the range does not exceed max_count registers (the modbus limit for a single read).
+def ess_plan_reads(register_names, max_gap, max_count=ESS_MAX_READ_COUNT):
+    plan = []
+    for register_name in sorted(register_names, key=lambda name: ESS_REGISTERS[name]["address"]):
         register = ESS_REGISTERS[register_name]
-        data[register_name] = ess_read_register(modbus, register)
-        await asyncio.sleep(0.01)
+        start = register["address"]
+        end = start + ess_register_size(register)
+        if len(plan) > 0:
+            block_start, block_end, block_registers = plan[-1]
+            if start - block_end <= max_gap and max(end, block_end) - block_start <= max_count:
+                plan[-1] = (block_start, max(end, block_end), block_registers)
+                block_registers.append(register_name)
+                continue
+        plan.append((start, end, [register_name]))
+    return [(start, end - start, tuple(registers)) for start, end, registers in plan]
+
+
+# Modbus client that keeps a single TCP connection to the ESS open. The synchronous pyModbusTCP client runs on a
+# dedicated worker thread so a slow or offline ESS never blocks the event loop. After a failure the connection is
+# closed and requests fail fast until the reconnect backoff (doubling from reconnect_min up to reconnect_max) expires.
+class EssModbus:
+    def __init__(self, host, port, unit_id, timeout, reconnect_min=ESS_RECONNECT_MIN, reconnect_max=ESS_RECONNECT_MAX):
+        from pyModbusTCP.client import ModbusClient
+        self.client = ModbusClient(host=host, port=port, unit_id=unit_id, timeout=timeout, auto_open=True, auto_close=False)
+        self.timeout = timeout
+        self.reconnect_min = reconnect_min
+        self.reconnect_max = reconnect_max
+        self.reconnect_delay = 0
+        self.reconnect_time = 0
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="ess_modbus")
+
+    def _read(self, address, count):
+        values = self.client.read_holding_registers(address, count)
+        if values is None:
+            self.client.close()
+        return values
+
+    def _failed(self):
+        self.reconnect_delay = min(max(self.reconnect_delay * 2, self.reconnect_min), self.reconnect_max)
+        self.reconnect_time = time.time() + self.reconnect_delay
+        print(f"ESS modbus request failed, retrying in {self.reconnect_delay:0.1f}s")
+
+    async def read_holding_registers(self, address, count, timeout=None):
+        if time.time() < self.reconnect_time:
+            return None
+        loop = asyncio.get_running_loop()
+        start = time.perf_counter()
+        try:
+            values = await asyncio.wait_for(loop.run_in_executor(self.executor, self._read, address, count), timeout or self.timeout)
+        except asyncio.TimeoutError:
+            values = None
+        METRICS.observe("sunpower_ess_request_seconds", time.perf_counter() - start)
+        METRICS.inc("sunpower_ess_requests_total")
+        if values is None:
+            METRICS.inc("sunpower_ess_request_failures_total")
+            self._failed()
+        else:
+            self.reconnect_delay = 0
+        return values
+
+    def close(self):
+        self.executor.submit(self.client.close)
+        self.executor.shutdown(wait=False)
+
+
+# Reads and decodes the registers of a read plan. The raw (start, values) blocks are appended to blocks if given.
+@timed("sunpower_ess_read_seconds")
+async def ess_read_registers(modbus, plan, blocks=None):
+    data = {}
+    for start, count, register_names in plan:
+        values = await modbus.read_holding_registers(start, count)
+        if values is None:
+            print(f"Failed to read {count} registers at {start}")
+            break
+        if blocks is not None:
+            blocks.append((start, values))
+        for register_name in register_names:
+            register = ESS_REGISTERS[register_name]
+            offset = register["address"] - start
+            data[register_name] = ess_decode_register(register, values[offset:offset + ess_register_size(register)])
     return data
 
 
-def merge_ess_into_pvs():
-    global ESS_DATA_VALID
-    if PVS_DATA_VALID and ESS_DATA_SAMPLED:
-        battery_index = 1
-        charge_values = []
-        health_values = []
-        for device_key in PVS_DATA:
-            device_type, _ = split_device_key(device_key)
-            for field in PVS_METADATA[device_type]['fields']:
-                field_metadata = PVS_METADATA[device_type]['fields'][field]
-                if field_metadata['source'] == "ess" and field_metadata['raw_name'] != "":
-                    raw_field_name = field_metadata['raw_name']
-                    if "%d" in raw_field_name:
-                        raw_field_name = raw_field_name % battery_index
-                    value = ESS_DATA[raw_field_name]
-                    if field_metadata['transform'] is not None:
-                        value = field_metadata['transform'](value)
-                    PVS_DATA[device_key][field] = value
-                    if device_type == "ess_bms":
-                        if field == "charge":
-                            charge_values.append(value)
-                        elif field == "health":
-                            health_values.append(value)
-            if device_type == "ess_bms":
-                battery_index += 1
-        for device_key in PVS_DATA:
-            device_type, _ = split_device_key(device_key)
-            for field in PVS_METADATA[device_type]['fields']:
-                field_metadata = PVS_METADATA[device_type]['fields'][field]
-                if field_metadata['source'] == "ess" and field_metadata['raw_name'] == "":
-                    PVS_DATA[device_key][field] = field_metadata['transform'](None)
-        ESS_DATA_VALID = True
-
-
-async def ess_sample():
-    if not ESS_ENABLED:
-        return
-    global ESS_DATA
-    global ESS_DATA_SAMPLED
-    host = ESS_HOST
-    if host == "":
-        host = ess_find_host(ESS_PORT)
-    modbus = ModbusClient(host=host, port=ESS_PORT, auto_open=True, auto_close=True, unit_id=ESS_UNIT_ID, timeout=ESS_TIMEOUT)
-    target_time = time.time() + ESS_SAMPLE_PERIOD
-    while True:
-        ESS_DATA = await ess_read_registers(modbus, ESS_REGISTERS_TO_READ)
-        ESS_DATA_SAMPLED = True
-        merge_ess_into_pvs()
-        sleep_time = target_time - time.time()
-        await asyncio.sleep(sleep_time)
-        target_time += ESS_SAMPLE_PERIOD
+# Decodes the registers of the site that lie entirely within the given (start, values) blocks.
+def ess_decode_blocks(site, blocks):
+    data = {}
+    for start, values in blocks:
+        for register_name in site.ess_registers_to_read:
+            register = ESS_REGISTERS[register_name]
+            offset = register["address"] - start
+            size = ess_register_size(register)
+            if offset >= 0 and offset + size <= len(values):
+                data[register_name] = ess_decode_register(register, values[offset:offset + size])
+    return data
+
+
+@timed("sunpower_merge_seconds")
+def merge_ess_into_pvs(site):
+    if site.pvs_data_valid and site.ess_data_sampled:
+        for device_key, (device_type, data, plan) in site.ess_device_plans.items():
+            for raw_name, field, transform in plan:
+                if raw_name in site.ess_data:
+                    value = site.ess_data[raw_name]
+                    setattr(data, field, value if transform is None else transform(value))
+            if HISTORY_ENABLED:
+                history_record(site, device_key, data, HISTORY_PLANS[device_type]["ess"], site.ess_sample_time)
+            if device_type in site.rollups:
+                site.rollups[device_type].update(device_key, data)
+        for device_key, (device_type, data, plan) in site.ess_derived_plans.items():
+            for _, field, transform in plan:
+                setattr(data, field, transform(site))
+            if HISTORY_ENABLED:
+                history_record(site, device_key, data, HISTORY_PLANS[device_type]["derived"], site.ess_sample_time)
+        rollup_publish(site, site.ess_sample_time)
+        if not site.ess_data_valid:
+            site.ess_data_valid = True
+            mqtt_request_publish()
+
+
+def ess_due_refresh(site, now):
+    due = ["fast"]
+    if site.ess_refresh_time["static"] is None:
+        due.append("static")
+    if site.ess_refresh_time["slow"] is None or now - site.ess_refresh_time["slow"] >= site.ess_slow_sample_period:
+        due.append("slow")
+    due = tuple(due)
+    if due not in site.ess_read_plans:
+        site.ess_read_plans[due] = ess_plan_reads([register for refresh in due for register in site.ess_registers_by_refresh[refresh]], site.ess_read_gap)
+    return due, site.ess_read_plans[due]
+
+
+# Samples the ESS faster while the battery power is changing quickly.
+def ess_sample_period(site):
+    return site.ess_fast_sample_period if abs(site.ess_power_delta) >= site.ess_fast_power_delta else site.ess_sample_period
+
+
+async def ess_sample(site):
+    if site.ess_modbus is None:
+        host = site.ess_host
+        if host == "":
+            host = await ess_find_host(site, site.ess_port)
+            if host is None:
+                raise ConnectionError("ESS not found")
+        site.ess_modbus = EssModbus(host, site.ess_port, site.ess_unit_id, site.ess_timeout)
+    now = time.time()
+    due, plan = ess_due_refresh(site, now)
+    blocks = [] if CAPTURE is not None else None
+    data = await ess_read_registers(site.ess_modbus, plan, blocks)
+    if len(data) == 0:
+        site.ess_failures += 1
+        # A discovered ESS that stopped answering may have moved, find it again on the next sample.
+        if site.ess_host == "" and site.ess_failures >= site.ess_rescan_failures:
+            print(f"ESS did not answer {site.ess_failures} samples in a row, searching for it again")
+            site.ess_modbus.close()
+            site.ess_modbus = None
+            site.ess_failures = 0
+        raise ConnectionError("No ESS registers could be read")
+    site.ess_failures = 0
+    if CAPTURE is not None:
+        CAPTURE.append(Capture.ESS, site, now, Capture.pack_blocks(blocks))
+    for refresh in due:
+        if refresh in site.ess_refresh_time and all(register in data for register in site.ess_registers_by_refresh[refresh]):
+            site.ess_refresh_time[refresh] = now
+    ess_apply_sample(site, data, now)
+
+
+def ess_apply_sample(site, data, sample_time):
+    if "battery_power_net" in data and "battery_power_net" in site.ess_data:
+        site.ess_power_delta = data["battery_power_net"] - site.ess_data["battery_power_net"]
+    site.ess_data.update(data)
+    site.ess_sample_time = sample_time
+    site.ess_data_sampled = True
+    merge_ess_into_pvs(site)
+    sample_processed(site, sample_time)
+
+
+# Fixed size ring of rows stored in typed arrays, one array for the timestamps (whole seconds) and one per column.
+class HistoryRing:
+    def __init__(self, size, typecodes):
+        self.size = size
+        self.start = 0
+        self.count = 0
+        self.times = array("I", bytes(4 * size))
+        self.columns = [array(typecode, bytes(array(typecode).itemsize * size)) for typecode in typecodes]
+
+    def append(self, timestamp, *values):
+        index = (self.start + self.count) % self.size
+        if self.count == self.size:
+            self.start = (self.start + 1) % self.size
+        else:
+            self.count += 1
+        self.times[index] = timestamp
+        for column, value in zip(self.columns, values):
+            column[index] = value
+
+    def last_time(self):
+        return self.times[(self.start + self.count - 1) % self.size] if self.count > 0 else 0
+
+    def query(self, start, end):
+        rows = []
+        for offset in range(self.count):
+            index = (self.start + offset) % self.size
+            if start <= self.times[index] < end:
+                rows.append((self.times[index], *(column[index] for column in self.columns)))
+        return rows
+
+
+# Rolls samples up into fixed width buckets of (min, max, avg, count). The open bucket is updated as every sample
+# arrives and appended to the ring once a sample for a later bucket shows up.
+class HistoryRollup:
+    def __init__(self, width, size):
+        self.width = width
+        self.ring = HistoryRing(size, ("f", "f", "f", "I"))
+        self.bucket = None
+
+    def add(self, timestamp, value):
+        bucket = timestamp - timestamp % self.width
+        if bucket != self.bucket:
+            if self.bucket is not None:
+                self.ring.append(self.bucket, *self.current())
+            self.bucket = bucket
+            self.min = self.max = value
+            self.sum = 0.0
+            self.count = 0
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+        self.sum += value
+        self.count += 1
+
+    def current(self):
+        return (self.min, self.max, self.sum / self.count, self.count)
+
+    def query(self, start, end):
+        rows = self.ring.query(start, end)
+        if self.bucket is not None and start <= self.bucket < end:
+            rows.append((self.bucket, *self.current()))
+        return rows
+
+
+# History of a single device field: the latest raw samples plus 5 minute and hourly rollups.
+class HistorySeries:
+    RESOLUTIONS = { "raw": 0, "5m": 300, "1h": 3600 }
+
+    def __init__(self):
+        self.raw = HistoryRing(HISTORY_RAW_SAMPLES, ("d",))
+        self.rollups = { "5m": HistoryRollup(300, HISTORY_FIVE_MINUTE_BUCKETS), "1h": HistoryRollup(3600, HISTORY_HOURLY_BUCKETS) }
+
+    def add(self, timestamp, value):
+        if timestamp <= self.raw.last_time():
+            return
+        self.raw.append(timestamp, value)
+        for rollup in self.rollups.values():
+            rollup.add(timestamp, value)
+
+    def query(self, start, end, resolution):
+        if resolution == "raw":
+            return self.raw.query(start, end)
+        return self.rollups[resolution].query(start, end)
+
+
+# Fields kept in the history for each device type split by source, the fields with a state class (or every field
+# when all_numeric is set, non numeric values are skipped when recorded).
+HISTORY_PLANS = {
+    device_type: { source: tuple(field for _, field, _ in entries if HISTORY_ALL_NUMERIC or PVS_METADATA[device_type]['fields'][field]['state_class'] is not None) for source, entries in plans.items() }
+    for device_type, plans in PVS_PLANS.items()
+}
+
+
+def history_record(site, device_key, data, fields, timestamp):
+    timestamp = int(timestamp)
+    for field in fields:
+        value = getattr(data, field)
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            continue
+        series = site.history.get((device_key, field))
+        if series is None:
+            series = site.history[(device_key, field)] = HistorySeries()
+        series.add(timestamp, value)
+
+
+# Returns the history of a device field between start and end (UNIX seconds) as (time, value) rows for the raw
+# resolution or (time, min, max, avg, count) rows for the 5m and 1h resolutions.
+def history_query(site, device_key, field, start=0, end=None, resolution="raw"):
+    series = site.history.get((device_key, field))
+    if series is None:
+        return []
+    return series.query(start, time.time() + 1 if end is None else end, resolution)
+
+
+# Returns the min, max, avg and number of samples of a device field between start and end, using the finest
+# resolution that still covers start.
+def history_aggregate(site, device_key, field, start, end=None):
+    series = site.history.get((device_key, field))
+    if series is None:
+        return None
+    end = time.time() + 1 if end is None else end
+    if series.raw.count > 0 and series.raw.times[series.raw.start] <= start:
+        values = [value for _, value in series.raw.query(start, end)]
+        rows = [(value, value, value, 1) for value in values]
+    else:
+        resolution = "5m"
+        five_minute = series.rollups["5m"].ring
+        if five_minute.count == 0 or five_minute.times[five_minute.start] > start:
+            resolution = "1h"
+        rows = [row[1:] for row in series.query(start, end, resolution)]
+    if len(rows) == 0:
+        return None
+    count = sum(row[3] for row in rows)
+    return {
+        "min": min(row[0] for row in rows),
+        "max": max(row[1] for row in rows),
+        "avg": sum(row[2] * row[3] for row in rows) / count,
+        "count": count,
+    }
 
 
 def get_safe_name(name):
     return name.lower().replace(" ", "_")
 
 
-def homeassistant_device_config(device_key, model, name, serial_number):
+def homeassistant_device_config(site, device_key, model, name, serial_number):
     return {
         # "connections": [["mac", address]],
         # "hw_version" "",
-        "identifiers": [get_safe_name(f"{MQTT_TOPIC_PREFIX}_{device_key}")],
+        "identifiers": [get_safe_name(f"{site.unique_prefix}_{device_key}")],
         "manufacturer": "SunPower",
         "model": model,
         # "model_id": "",
@@ -505,16 +1489,19 @@ def homeassistant_device_config(device_key, model, name, serial_number):
     }
 
 
-def homeassistant_config(device_config, device_key, field, name, state_class, device_class, unit_of_measurement):
+def homeassistant_config(site, device_config, device_key, field, name, state_class, device_class, unit_of_measurement):
     payload_json = {
-        "unique_id": f"{MQTT_TOPIC_PREFIX}_{device_key}_{field}",
-        "object_id": f"{MQTT_TOPIC_PREFIX}_{device_key}_{field}",
+        "unique_id": f"{site.unique_prefix}_{device_key}_{field}",
+        "object_id": f"{site.unique_prefix}_{device_key}_{field}",
         "name": name,
-        "state_topic": f"{MQTT_TOPIC_PREFIX}/{device_key}/data",
+        "state_topic": f"{site.topic_prefix}/{device_key}/data",
         "value_template": "{{ value_json." + field + " }}",
         "device": device_config,
-        "availability_topic": f"{MQTT_TOPIC_PREFIX}/{device_key}/data",
-        "availability_template": "{{ value_json.available }}",
+        "availability": [
+            { "topic": MQTT_STATUS_TOPIC },
+            { "topic": f"{site.topic_prefix}/{device_key}/data", "value_template": "{{ value_json.available }}" },
+        ],
+        "availability_mode": "all",
     }
     if state_class is not None:
         payload_json["state_class"] = state_class
@@ -523,59 +1510,1110 @@ def homeassistant_config(device_config, device_key, field, name, state_class, de
     if unit_of_measurement is not None:
         payload_json["unit_of_measurement"] = unit_of_measurement
     return {
-        "topic": f"homeassistant/sensor/{MQTT_TOPIC_PREFIX}_{device_key}/{field}/config",
-        "payload": json.dumps(payload_json)
+        "topic": f"homeassistant/sensor/{site.unique_prefix}_{device_key}/{field}/config",
+        "payload": json.dumps(payload_json),
+        "retain": True,
     }
 
 
-async def mqtt_publish():
-    available_time = max(PVS_SAMPLE_PERIOD, ESS_SAMPLE_PERIOD) * 1.50
-    target_time = time.time() + MQTT_PUBLISH_PERIOD
-    while True:
-        if not MQTT_ENABLED:
+# Returns the discovery config of the fields of a device not published yet, the published fields are tracked in the
+# site's homeassistant_config_cache which is cleared when the MQTT session reconnects so the broker is resynchronized.
+# A field is only added to the cache once its message is published, a failed publish is retried on the next poll.
+def homeassistant_config_messages(site, info, data):
+    device_key = info.key
+    signature = (data['model'], info.display_name, data['serial_number'])
+    cached = site.homeassistant_config_cache.get(device_key)
+    if cached is None or cached[0] != signature:
+        cached = (signature, set())
+        site.homeassistant_config_cache[device_key] = cached
+    published = cached[1]
+    messages = []
+    device_config = None
+    for field, field_data in info.metadata['fields'].items():
+        if field not in data or field in published:
+            continue
+        if device_config is None:
+            device_config = homeassistant_device_config(site, device_key, *signature)
+        message = homeassistant_config(site, device_config, device_key, field, field_data['name'], field_data['state_class'], field_data['device_class'], field_data['unit_of_measurement'])
+        message["published"] = (published, field)
+        messages.append(message)
+    return messages
+
+
+# Long lived MQTT session. The paho network loop runs on its own thread and reconnects automatically, publishing
+# only queues the message so the event loop is never blocked. QoS 1 messages are limited to max_inflight
+# unacknowledged messages at a time, the broker publishes the retained offline status if the connection is lost.
+class MqttPublisher:
+    def __init__(self, host, port, username, password, qos=MQTT_QOS, max_inflight=MQTT_MAX_INFLIGHT, keepalive=MQTT_KEEPALIVE):
+        self.host = host
+        self.port = port
+        self.qos = qos
+        self.keepalive = keepalive
+        self.connected = False
+        self.resync = False
+        self.inflight = set()
+        self.window = asyncio.Semaphore(max_inflight)
+        self.loop = None
+        import paho.mqtt.client as mqtt
+        self.client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
+        if username != "":
+            self.client.username_pw_set(username, password)
+        self.client.max_inflight_messages_set(max_inflight)
+        self.client.reconnect_delay_set(1, 120)
+        self.client.will_set(MQTT_STATUS_TOPIC, "offline", qos=1, retain=True)
+        self.client.on_connect = self._on_connect
+        self.client.on_disconnect = self._on_disconnect
+        self.client.on_publish = self._on_publish
+
+    def start(self):
+        self.loop = asyncio.get_running_loop()
+        self.client.connect_async(self.host, self.port, self.keepalive)
+        self.client.loop_start()
+
+    def stop(self):
+        self.client.publish(MQTT_STATUS_TOPIC, "offline", qos=1, retain=True)
+        self.client.disconnect()
+        self.client.loop_stop()
+
+    def _on_connect(self, client, userdata, flags, reason_code, properties):
+        if reason_code.is_failure:
+            print(f"MQTT connection failed: {reason_code}")
+            return
+        self.connected = True
+        self.resync = True
+        client.publish(MQTT_STATUS_TOPIC, "online", qos=1, retain=True)
+        self.loop.call_soon_threadsafe(mqtt_request_publish)
+
+    def _on_disconnect(self, client, userdata, flags, reason_code, properties):
+        self.connected = False
+        self.loop.call_soon_threadsafe(self._reset_window)
+
+    def _on_publish(self, client, userdata, mid, reason_code, properties):
+        self.loop.call_soon_threadsafe(self._release, mid)
+
+    def _release(self, mid):
+        if mid in self.inflight:
+            self.inflight.remove(mid)
+            self.window.release()
+
+    def _reset_window(self):
+        for _ in range(len(self.inflight)):
+            self.window.release()
+        self.inflight.clear()
+
+    async def publish(self, topic, payload, retain=False):
+        if not self.connected:
+            return False
+        if self.qos > 0:
+            await self.window.acquire()
+        info = self.client.publish(topic, payload, qos=self.qos, retain=retain)
+        if info.rc != 0:
+            if self.qos > 0:
+                self.window.release()
+            return False
+        if self.qos > 0:
+            self.inflight.add(info.mid)
+        METRICS.inc("sunpower_mqtt_messages_total")
+        # Buffered payloads are already bytes, fresh ones are str and sent UTF-8 encoded.
+        METRICS.inc("sunpower_mqtt_bytes_total", len(payload.encode()) if isinstance(payload, str) else len(payload))
+        return True
+
+
+# Compares two snapshots of a device state.
+def mqtt_state_changed(device_type, fields, snapshot, last_snapshot):
+    for field, value, last_value in zip(fields, snapshot, last_snapshot):
+        if field == 'last_sample_time':
+            continue
+        if value == last_value:
+            continue
+        deadband = MQTT_DEADBANDS.get((device_type, field), 0)
+        if isinstance(value, (int, float)) and isinstance(last_value, (int, float)) and abs(value - last_value) <= deadband:
+            continue
+        return True
+    return False
+
+
+MQTT_PUBLISHER = None
+MQTT_SCHEDULER = None
+
+
+# Publishes as soon as possible instead of at the next publish period, used when a site first has data to publish
+# and when the connection to the MQTT server comes up.
+def mqtt_request_publish():
+    if MQTT_SCHEDULER is not None:
+        MQTT_SCHEDULER.wake()
+
+
+# Fixed size, memory mapped FIFO of timestamped MQTT messages used to store device data while the MQTT server
+# cannot be reached. The file holds two alternating headers followed by the ring of records, a record is written
+# before the header that references it so a crash never exposes a partial record. When the ring is full the
+# oldest records are dropped. Records are numbered in the order they are appended, first is the number of the
+# oldest record so a reader can consume what it peeked even when records were dropped in the meantime.
+class MessageBuffer:
+    MAGIC = b"SPMQBUF1"
+    HEADER = struct.Struct("<8sQQQQQQQI")  # magic, sequence, capacity, head, tail, used, count, dropped, crc
+    HEADER_SIZE = 256
+    RECORD = struct.Struct("<IId")  # length, crc, timestamp
+    WRAP = 0xFFFFFFFF
+
+    def __init__(self, path, size):
+        self.capacity = size - self.HEADER_SIZE
+        if os.path.exists(path) and os.path.getsize(path) not in (0, size):
+            self._resize(path, size)
+        exists = os.path.exists(path) and os.path.getsize(path) == size
+        self.file = open(path, "r+b" if exists else "w+b")
+        if not exists:
+            self.file.truncate(size)
+        self.mmap = mmap.mmap(self.file.fileno(), size)
+        self.sequence = 0
+        self.head = 0
+        self.tail = 0
+        self.used = 0
+        self.count = 0
+        self.dropped = 0
+        self.first = 0
+        if exists:
+            self._recover()
+        self._write_header()
+
+    # Moves the messages of a buffer file of another size into a new file of the given size, keeping the newest when
+    # they do not all fit. The old file is only replaced once the new one is complete.
+    @classmethod
+    def _resize(cls, path, size):
+        old_size = os.path.getsize(path)
+        records = []
+        if old_size > cls.HEADER_SIZE + cls.RECORD.size:
+            old = cls(path, old_size)
+            records = old.peek(old.count)
+            old.close()
+        resized_path = f"{path}.resize"
+        if os.path.exists(resized_path):
+            os.remove(resized_path)
+        resized = cls(resized_path, size)
+        for record in records:
+            resized.append(*record)
+        resized.close()
+        os.replace(resized_path, path)
+        print(f"Buffer resized from {old_size} to {size} bytes, kept {resized.count} of {len(records)} messages")
+
+    def _read_header(self, slot):
+        fields = self.HEADER.unpack_from(self.mmap, slot * (self.HEADER_SIZE // 2))
+        if fields[0] != self.MAGIC or fields[-1] != zlib.crc32(self.HEADER.pack(*fields[:-1], 0)) or fields[2] != self.capacity:
+            return None
+        return fields
+
+    def _write_header(self):
+        self.sequence += 1
+        fields = (self.MAGIC, self.sequence, self.capacity, self.head, self.tail, self.used, self.count, self.dropped)
+        self.HEADER.pack_into(self.mmap, (self.sequence % 2) * (self.HEADER_SIZE // 2), *fields, zlib.crc32(self.HEADER.pack(*fields, 0)))
+
+    # Loads the newest valid header and keeps the records that pass their checksum.
+    def _recover(self):
+        headers = [header for header in (self._read_header(0), self._read_header(1)) if header is not None]
+        if len(headers) == 0:
+            return
+        _, self.sequence, _, self.head, self.tail, self.used, self.count, self.dropped, _ = max(headers, key=lambda header: header[1])
+        position, used, count = self.tail, 0, 0
+        while count < self.count:
+            position, used, record = self._read(position, used)
+            if record is None:
+                break
+            count += 1
+        if count < self.count:
+            print(f"Buffer recovered {count} of {self.count} messages")
+            self.head, self.used, self.count = position, used, count
+
+    # Reads the record at position, returning the position and used bytes after it and the record (None if invalid).
+    def _read(self, position, used):
+        if self.capacity - position < self.RECORD.size or self.RECORD.unpack_from(self.mmap, self.HEADER_SIZE + position)[0] == self.WRAP:
+            used += self.capacity - position
+            position = 0
+        length, crc, timestamp = self.RECORD.unpack_from(self.mmap, self.HEADER_SIZE + position)
+        start = self.HEADER_SIZE + position + self.RECORD.size
+        if position + self.RECORD.size + length > self.capacity or zlib.crc32(self.mmap[start:start + length]) != crc:
+            return position, used, None
+        topic, payload = self.mmap[start:start + length].split(b"\0", 1)
+        size = self.RECORD.size + length
+        return position + size, used + size, (timestamp, topic.decode(), payload)
+
+    def _drop(self, count):
+        for _ in range(count):
+            self.tail, used, _ = self._read(self.tail, 0)
+            self.used -= used
+            self.count -= 1
+            self.first += 1
+        if self.count == 0:
+            self.head, self.tail, self.used = 0, 0, 0
+
+    def append(self, timestamp, topic, payload):
+        data = topic.encode() + b"\0" + (payload.encode() if isinstance(payload, str) else payload)
+        size = self.RECORD.size + len(data)
+        if size > self.capacity:
+            self.dropped += 1
+            return
+        if self.head + size > self.capacity:
+            while self.count > 0 and self.tail >= self.head:
+                self._drop(1)
+                self.dropped += 1
+            if self.count > 0:
+                if self.capacity - self.head >= 4:
+                    struct.pack_into("<I", self.mmap, self.HEADER_SIZE + self.head, self.WRAP)
+                self.used += self.capacity - self.head
+            self.head = 0
+        while self.count > 0 and self.head <= self.tail < self.head + size:
+            self._drop(1)
+            self.dropped += 1
+        self.RECORD.pack_into(self.mmap, self.HEADER_SIZE + self.head, len(data), zlib.crc32(data), timestamp)
+        self.mmap[self.HEADER_SIZE + self.head + self.RECORD.size:self.HEADER_SIZE + self.head + size] = data
+        self.head += size
+        self.used += size
+        self.count += 1
+        self._write_header()
+
+    def peek(self, count):
+        records = []
+        position = self.tail
+        for _ in range(min(count, self.count)):
+            position, _, record = self._read(position, 0)
+            records.append(record)
+        return records
+
+    # Removes the count records starting with record number start, those already dropped are skipped.
+    def consume(self, start, count):
+        self._drop(max(min(start + count - self.first, self.count), 0))
+        self._write_header()
+
+    # Writes the mapping to disk on an executor thread so the event loop is not blocked by the disk.
+    async def flush(self):
+        await asyncio.get_running_loop().run_in_executor(None, self.mmap.flush)
+
+    def close(self):
+        self.mmap.flush()
+        self.mmap.close()
+        self.file.close()
+
+    def stats(self):
+        return { "messages": self.count, "bytes": self.used, "dropped": self.dropped }
+
+
+# Opened by main so every worker process gets its own file.
+MQTT_BUFFER = None
+
+
+def metrics_collect_buffer(metrics):
+    for name, value in MQTT_BUFFER.stats().items():
+        metrics.set(f"sunpower_buffer_{name}", value)
+
+
+# Buffer statistics last published to <topic_prefix>/buffer.
+MQTT_BUFFER_STATS = None
+
+
+# Publishes the buffered messages in order, at most drain_batch per period so the MQTT server is not flooded after
+# reconnecting. Stops at the first message that cannot be published.
+async def mqtt_drain_buffer():
+    if MQTT_PUBLISHER is None or not MQTT_PUBLISHER.connected or MQTT_BUFFER.count == 0:
+        return
+    # Publishing may wait for the inflight window while new messages push the oldest out of a full buffer, so the
+    # batch is consumed by record number rather than by count.
+    start = MQTT_BUFFER.first
+    published = 0
+    for _, topic, payload in MQTT_BUFFER.peek(BUFFER_DRAIN_BATCH):
+        if not await MQTT_PUBLISHER.publish(topic, payload):
+            break
+        published += 1
+    MQTT_BUFFER.consume(start, published)
+    await MQTT_BUFFER.flush()
+    if MQTT_BUFFER.count == 0:
+        print("Buffer drained")
+
+
+# A device is available while its last sample is less than 1.5 sample periods old.
+def site_update_availability(site, now):
+    available_time = max(site.pvs_sample_period, site.ess_sample_period) * 1.50
+    for data in site.pvs_data.values():
+        data.available = 'online' if (now - data.last_sample_time) < available_time else 'offline'
+
+
+# Publishes the data of every site with PVS data, the ESS fields follow once the ESS has been sampled. now defaults to
+# the current time, replay passes the recorded sample time.
+@timed("sunpower_mqtt_publish_seconds")
+async def mqtt_publish(now=None):
+    global MQTT_PUBLISHER
+    global MQTT_BUFFER_STATS
+    if MQTT_ENABLED and MQTT_PUBLISHER is None:
+        MQTT_PUBLISHER = MqttPublisher(MQTT_HOST, MQTT_PORT, MQTT_USERNAME, MQTT_PASSWORD)
+        MQTT_PUBLISHER.start()
+    publisher = MQTT_PUBLISHER
+    if not MQTT_ENABLED:
+        for site in SITES:
             printed = False
-            for device_key, data in PVS_DATA.items():
+            for device_key, data in site.pvs_data.items():
                 printed = True
-                if device_key.startswith("gateway"):
+                device_type = site.devices[device_key].device_type
+                if device_type == "gateway":
                     print(f"GTW: {data['charge_total']:0.3f},{data['inverter_total']:0.3f},{data['power']:0.3f}")
-                elif device_key.startswith("ess_bms"):
+                elif device_type == "ess_bms":
                     print(f"BMS: {data['charge_total']:0.3f},{data['inverter_total']:0.3f},{data['charge']}")
-                elif device_key.startswith("inverter"):
+                elif device_type == "inverter":
                     print(f"INV: {data['energy_total']:0.3f},{data['power']:0.3f},{data['temperature']}")
             if printed:
-                print(PVS_DATA)
-        elif PVS_DATA_VALID and ESS_DATA_VALID:
-            messages = []
-            for device_key, data in PVS_DATA.items():
-                data['available'] = 'online' if (time.time() - data['last_sample_time']) < available_time else 'offline'
-                for prefix in PVS_METADATA:
-                    if device_key.startswith(prefix):
-                        device_name = PVS_METADATA[prefix]['name']
-                        id = data['serial_number'].lower()
-                        if SERIAL_TO_ID_ENABLED and id in SERIAL_TO_ID_MAP:
-                            id = SERIAL_TO_ID_MAP[id]
-                        device_config = homeassistant_device_config(device_key, data['model'], f"{device_name} {id}".strip(), data['serial_number'])
-                        for field in PVS_METADATA[prefix]['fields']:
-                            if field not in data:
-                                continue
-                            field_data = PVS_METADATA[prefix]['fields'][field]
-                            field_config = homeassistant_config(device_config, device_key, field, field_data['name'], field_data['state_class'], field_data['device_class'], field_data['unit_of_measurement'])
-                            if HOMEASSISTANT_SEND_CONFIG:
-                                messages.append(field_config)
-                messages.append({ "topic": f"{MQTT_TOPIC_PREFIX}/{device_key}/data", "payload": json.dumps(data) })
-            if len(messages) > 0:
-                auth = None
-                if MQTT_USERNAME != "":
-                    auth = { "username": MQTT_USERNAME, "password": MQTT_PASSWORD }
-                publish.multiple(messages, hostname=MQTT_HOST, port=MQTT_PORT, auth=auth)
-        sleep_time = target_time - time.time()
-        await asyncio.sleep(sleep_time)
-        target_time += MQTT_PUBLISH_PERIOD
-
-
-async def main():
-    await asyncio.gather(pvs_sample(), ess_sample(), mqtt_publish())
-
-
-asyncio.run(main())
+                print(site.pvs_data)
+        return
+    sites = [site for site in SITES if site.pvs_data_valid]
+    if len(sites) == 0:
+        return
+    if publisher.resync:
+        publisher.resync = False
+        for site in SITES:
+            site.homeassistant_config_cache.clear()
+            site.mqtt_last_state.clear()
+        MQTT_BUFFER_STATS = None
+    messages = []
+    now = time.time() if now is None else now
+    for site in sites:
+        site_update_availability(site, now)
+        for device_key, data in site.pvs_data.items():
+            info = site.devices[device_key]
+            if HOMEASSISTANT_SEND_CONFIG:
+                messages += homeassistant_config_messages(site, info, data)
+            last = site.mqtt_last_state.get(device_key)
+            snapshot = data.snapshot()
+            if last is None or now - last[0] >= MQTT_HEARTBEAT_PERIOD or mqtt_state_changed(info.device_type, data.FIELDS, snapshot, last[1]):
+                messages.append({ "topic": f"{site.topic_prefix}/{device_key}/data", "payload": data.to_json(), "site": site, "device_key": device_key, "data": snapshot })
+    METRICS.set("sunpower_mqtt_batch_messages", len(messages))
+    if METRICS_MQTT:
+        messages.append({ "topic": f"{MQTT_TOPIC_PREFIX}/diagnostics", "payload": json.dumps(METRICS.summary()) })
+    buffered = 0
+    for message in messages:
+        if "device_key" not in message:
+            if await publisher.publish(message["topic"], message["payload"], message.get("retain", False)) and "published" in message:
+                published, field = message["published"]
+                published.add(field)
+            continue
+        # Once messages are buffered new device data is buffered behind them so it is delivered in order.
+        if (MQTT_BUFFER is None or MQTT_BUFFER.count == 0) and await publisher.publish(message["topic"], message["payload"]):
+            message["site"].mqtt_last_state[message["device_key"]] = (now, message["data"])
+        elif MQTT_BUFFER is not None:
+            MQTT_BUFFER.append(now, message["topic"], message["payload"])
+            message["site"].mqtt_last_state[message["device_key"]] = (now, message["data"])
+            buffered += 1
+    if MQTT_BUFFER is not None:
+        if buffered > 0:
+            await MQTT_BUFFER.flush()
+        stats = MQTT_BUFFER.stats()
+        if stats != MQTT_BUFFER_STATS and await publisher.publish(f"{MQTT_TOPIC_PREFIX}/buffer", json.dumps(stats), True):
+            MQTT_BUFFER_STATS = stats
+
+
+# Base of the export sinks. offer() queues points without ever blocking, once more than queue_size points are
+# queued the oldest are dropped. run() writes batches of up to batch_size points as soon as a batch is full and
+# whatever is queued every flush_interval seconds. A batch that fails to write stays queued and is retried after a
+# backoff, so a slow or failing sink holds up neither sampling nor the other sinks. Points are
+# (device type, site name, device key, sample time, fields, values) with the fields and values of
+# DeviceState.DYNAMIC_FIELDS, the first of which is last_sample_time and is not exported.
+class ExportSink:
+    NAME = ""
+
+    def __init__(self):
+        section = f"export.{self.NAME}"
+        self.batch_size = config.getint(section, "batch_size", fallback=500)
+        self.flush_interval = config.getfloat(section, "flush_interval", fallback=10)
+        self.queue_size = config.getint(section, "queue_size", fallback=10000)
+        self.queue = collections.deque()
+        # Number of points at the front of the queue that belong to the batch being written.
+        self.in_flight = 0
+        self.full = None
+
+    # Points of the batch being written that overflow the queue leave it but are still written, only the others count
+    # as dropped.
+    def offer(self, points):
+        self.queue.extend(points)
+        overflow = len(self.queue) - self.queue_size
+        if overflow > 0:
+            for _ in range(overflow):
+                self.queue.popleft()
+            in_flight = min(overflow, self.in_flight)
+            self.in_flight -= in_flight
+            if overflow > in_flight:
+                METRICS.inc("sunpower_export_dropped_total", overflow - in_flight, sink=self.NAME)
+        METRICS.set("sunpower_export_queued", len(self.queue), sink=self.NAME)
+        if len(self.queue) >= self.batch_size and self.full is not None:
+            self.full.set()
+
+    # Writes the queued points in batches, a batch leaves the queue once it has been written.
+    async def flush(self):
+        while len(self.queue) > 0:
+            batch = list(itertools.islice(self.queue, self.batch_size))
+            self.in_flight = len(batch)
+            try:
+                await self.write(batch)
+            except BaseException:
+                if len(batch) > self.in_flight:
+                    METRICS.inc("sunpower_export_dropped_total", len(batch) - self.in_flight, sink=self.NAME)
+                self.in_flight = 0
+                raise
+            for _ in range(self.in_flight):
+                self.queue.popleft()
+            self.in_flight = 0
+            METRICS.inc("sunpower_export_points_total", len(batch), sink=self.NAME)
+        METRICS.set("sunpower_export_queued", len(self.queue), sink=self.NAME)
+
+    async def run(self):
+        self.full = asyncio.Event()
+        failures = 0
+        while True:
+            try:
+                await asyncio.wait_for(self.full.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self.full.clear()
+            try:
+                await self.flush()
+                failures = 0
+            except Exception as e:
+                failures += 1
+                METRICS.inc("sunpower_export_failures_total", sink=self.NAME)
+                delay = min(SCHEDULER_BACKOFF_MIN * 2 ** (failures - 1), SCHEDULER_BACKOFF_MAX)
+                print(f"export {self.NAME} failed ({e!r}), retrying in {delay:0.1f}s")
+                await asyncio.sleep(delay)
+
+    # File sinks encode and write a batch on an executor thread so a slow disk does not block the event loop.
+    async def write(self, batch):
+        await asyncio.get_running_loop().run_in_executor(None, self.write_file, batch)
+
+    def write_file(self, batch):
+        raise NotImplementedError
+
+
+# Appends the data of a batch to each of its files (a dict of path to bytes). If a write fails every file is cut back
+# to its size before the batch, so the batch can be retried without writing any line twice.
+def export_append(contents):
+    written = []
+    try:
+        for path, data in contents.items():
+            with open(path, "ab", buffering=0) as file:
+                written.append((path, file.seek(0, os.SEEK_END)))
+                view = memoryview(data)
+                while len(view) > 0:
+                    view = view[file.write(view):]
+    except BaseException:
+        for path, size in written:
+            os.truncate(path, size)
+        raise
+
+
+def export_escape(text, characters):
+    for character in characters:
+        text = text.replace(character, "\\" + character)
+    return text
+
+
+# Encodes a point in the InfluxDB line protocol, the device is tagged with the site and device key. Returns None
+# when the point has no field that can be encoded.
+def export_line(point):
+    device_type, site_name, device_key, sample_time, fields, values = point
+    encoded = []
+    for field, value in itertools.islice(zip(fields, values), 1, None):
+        if value is MISSING or value is None:
+            continue
+        if isinstance(value, bool):
+            value = "true" if value else "false"
+        elif isinstance(value, int):
+            value = f"{value}i"
+        elif isinstance(value, float):
+            if not math.isfinite(value):
+                continue
+            value = repr(value)
+        else:
+            value = '"' + export_escape(value if isinstance(value, str) else json.dumps(value), ('\\', '"')) + '"'
+        encoded.append(export_escape(field, (",", "=", " ")) + "=" + value)
+    if len(encoded) == 0:
+        return None
+    tags = f",site={export_escape(site_name, (',', '=', ' '))}" if site_name != "" else ""
+    return f"{export_escape(device_type, (',', ' '))}{tags},device={export_escape(device_key, (',', '=', ' '))} {','.join(encoded)} {int(sample_time * 1000000000)}"
+
+
+# Appends the points to a file in the InfluxDB line protocol. Once the file reaches rotate_size it is renamed to
+# <path>.1 (the older files move up to <path>.<rotate_count>, the oldest is deleted) and a new file is started.
+class LineProtocolFileSink(ExportSink):
+    NAME = "line_protocol"
+
+    def __init__(self, path, rotate_size=EXPORT_LINE_PROTOCOL_ROTATE_SIZE, rotate_count=EXPORT_LINE_PROTOCOL_ROTATE_COUNT):
+        super().__init__()
+        self.path = path
+        self.rotate_size = rotate_size
+        self.rotate_count = rotate_count
+
+    def rotate(self):
+        if self.rotate_count <= 0:
+            os.remove(self.path)
+            return
+        for index in range(self.rotate_count - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{index}"):
+                os.replace(f"{self.path}.{index}", f"{self.path}.{index + 1}")
+        os.replace(self.path, f"{self.path}.1")
+
+    def write_file(self, batch):
+        if self.rotate_size > 0 and os.path.exists(self.path) and os.path.getsize(self.path) >= self.rotate_size:
+            self.rotate()
+        lines = "".join(line + "\n" for line in map(export_line, batch) if line is not None)
+        export_append({ self.path: lines.encode() })
+
+
+# Appends the points to CSV files in a directory, one file per device type and UTC day
+# (<device type>_<YYYY-MM-DD>.csv) with a column per field.
+class CsvFileSink(ExportSink):
+    NAME = "csv"
+
+    def __init__(self, directory):
+        super().__init__()
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def write_file(self, batch):
+        files = {}
+        for point in batch:
+            day = time.strftime("%Y-%m-%d", time.gmtime(point[3]))
+            files.setdefault((point[0], day), []).append(point)
+        contents = {}
+        for (device_type, day), points in files.items():
+            path = os.path.join(self.directory, f"{device_type}_{day}.csv")
+            text = io.StringIO()
+            writer = csv.writer(text)
+            if not os.path.exists(path) or os.path.getsize(path) == 0:
+                writer.writerow(["time", "site", "device_key", *points[0][4][1:]])
+            for _, site_name, device_key, sample_time, _, values in points:
+                writer.writerow([sample_time, site_name, device_key, *("" if value is MISSING else json.dumps(value) if isinstance(value, list) else value for value in values[1:])])
+            contents[path] = text.getvalue().encode()
+        export_append(contents)
+
+
+# Publishes every batch as one MQTT message holding the points in the line protocol.
+class MqttExportSink(ExportSink):
+    NAME = "mqtt"
+
+    def __init__(self, topic):
+        super().__init__()
+        self.topic = topic
+
+    async def write(self, batch):
+        payload = "\n".join(line for line in map(export_line, batch) if line is not None)
+        if MQTT_PUBLISHER is None or not await MQTT_PUBLISHER.publish(self.topic, payload):
+            raise ConnectionError("MQTT server not connected")
+
+
+EXPORT_SINKS = []
+
+
+def export_create_sinks(mqtt_enabled):
+    sinks = []
+    if EXPORT_LINE_PROTOCOL_ENABLED:
+        sinks.append(LineProtocolFileSink(EXPORT_LINE_PROTOCOL_PATH))
+    if EXPORT_CSV_ENABLED:
+        sinks.append(CsvFileSink(EXPORT_CSV_DIRECTORY))
+    if EXPORT_MQTT_ENABLED and mqtt_enabled:
+        sinks.append(MqttExportSink(EXPORT_MQTT_TOPIC))
+    return sinks
+
+
+# Queues the devices whose data changed since the last export of the site on every sink, stamped with the time of
+# the sample that changed them. last_sample_time (the first dynamic field) changes with every sample and is not
+# compared.
+def export_sample(site, sample_time):
+    points = []
+    for device_key, data in site.pvs_data.items():
+        values = data.get_dynamic_fields(data)
+        changed = values[1:]
+        if site.export_last_values.get(device_key) == changed:
+            continue
+        site.export_last_values[device_key] = changed
+        points.append((data.DEVICE_TYPE, site.name, device_key, sample_time, data.DYNAMIC_FIELDS, values))
+    if len(points) > 0:
+        for sink in EXPORT_SINKS:
+            sink.offer(points)
+
+
+# A pre-serialized JSON body with its validators. The ETag is derived from the content so it stays the same for as
+# long as the body does.
+class ApiResource:
+    __slots__ = ("body", "etag", "modified", "last_modified", "snapshot")
+
+    def __init__(self, body, modified, last_modified, snapshot=None):
+        self.body = body
+        self.etag = '"' + hashlib.blake2b(body, digest_size=8).hexdigest() + '"'
+        self.modified = modified
+        self.last_modified = last_modified
+        self.snapshot = snapshot
+
+
+# Device data of a site as served by the API, rebuilt after every sample. A device body is only encoded again when
+# the device state changed, the whole site body is joined from the device bodies. Stream handlers wait for the next
+# update with wait().
+class ApiSnapshot:
+    def __init__(self):
+        self.devices = {}
+        self.site = None
+        self.waiters = set()
+
+    def update(self, pvs_data, now):
+        import email.utils
+        last_modified = email.utils.formatdate(now, usegmt=True)
+        changed = self.site is None
+        for device_key, data in pvs_data.items():
+            snapshot = data.snapshot()
+            resource = self.devices.get(device_key)
+            if resource is None or resource.snapshot != snapshot:
+                self.devices[device_key] = ApiResource(data.to_json().encode(), now, last_modified, snapshot)
+                changed = True
+        if not changed:
+            return
+        body = b"{" + b", ".join(json.dumps(device_key).encode() + b": " + resource.body for device_key, resource in self.devices.items()) + b"}"
+        self.site = ApiResource(body, now, last_modified)
+        for waiter in self.waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+        self.waiters.clear()
+
+    # Waits up to timeout seconds for the next update.
+    async def wait(self, timeout):
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters.add(waiter)
+        try:
+            await asyncio.wait_for(waiter, timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            self.waiters.discard(waiter)
+
+
+# Hands a processed and merged sample to the API and the export sinks.
+def sample_processed(site, sample_time):
+    if not site.pvs_data_valid or not (API_ENABLED or len(EXPORT_SINKS) > 0):
+        return
+    site_update_availability(site, sample_time)
+    if API_ENABLED:
+        site.api_snapshot.update(site.pvs_data, sample_time)
+    if len(EXPORT_SINKS) > 0:
+        export_sample(site, sample_time)
+
+
+def api_site(request):
+    import aiohttp.web
+    name = request.match_info.get("site", "")
+    for site in SITES:
+        if site.name == name:
+            return site
+    raise aiohttp.web.HTTPNotFound(text=f"Unknown site {name}")
+
+
+# Answers with 304 when the client already holds the current body (If-None-Match, else If-Modified-Since).
+def api_respond(request, resource):
+    import aiohttp.web
+    headers = { "ETag": resource.etag, "Last-Modified": resource.last_modified, "Cache-Control": "no-cache" }
+    if_none_match = request.headers.get("If-None-Match")
+    if if_none_match is not None:
+        not_modified = any(tag.strip().removeprefix("W/") in (resource.etag, "*") for tag in if_none_match.split(","))
+    else:
+        not_modified = request.if_modified_since is not None and int(resource.modified) <= request.if_modified_since.timestamp()
+    METRICS.inc("sunpower_api_requests_total", status="304" if not_modified else "200")
+    if not_modified:
+        return aiohttp.web.Response(status=304, headers=headers)
+    return aiohttp.web.Response(body=resource.body, content_type="application/json", headers=headers)
+
+
+async def api_site_handler(request):
+    import aiohttp.web
+    site = api_site(request)
+    if site.api_snapshot.site is None:
+        raise aiohttp.web.HTTPServiceUnavailable(text="No data has been sampled yet")
+    return api_respond(request, site.api_snapshot.site)
+
+
+async def api_device_handler(request):
+    import aiohttp.web
+    site = api_site(request)
+    resource = site.api_snapshot.devices.get(request.match_info["device_key"])
+    if resource is None:
+        raise aiohttp.web.HTTPNotFound(text=f"Unknown device {request.match_info['device_key']}")
+    return api_respond(request, resource)
+
+
+# Server-sent events stream of the whole site body, an event is sent as soon as a sample changed the data and a
+# comment every API_KEEPALIVE seconds otherwise.
+async def api_stream_handler(request):
+    import aiohttp.web
+    site = api_site(request)
+    response = aiohttp.web.StreamResponse(headers={ "Content-Type": "text/event-stream", "Cache-Control": "no-cache" })
+    await response.prepare(request)
+    METRICS.inc("sunpower_api_streams_total")
+    sent = None
+    while True:
+        resource = site.api_snapshot.site
+        if resource is not None and resource is not sent:
+            await response.write(b"id: " + resource.etag[1:-1].encode() + b"\ndata: " + resource.body + b"\n\n")
+            sent = resource
+        else:
+            await response.write(b": keepalive\n\n")
+        await site.api_snapshot.wait(API_KEEPALIVE)
+
+
+# Reads the device field and the start and end query parameters (UNIX seconds) of a history request.
+def api_history_request(request):
+    import aiohttp.web
+    site = api_site(request)
+    device_key = request.match_info["device_key"]
+    field = request.match_info["field"]
+    if (device_key, field) not in site.history:
+        raise aiohttp.web.HTTPNotFound(text=f"No history of {field} of {device_key}")
+    try:
+        start = float(request.query.get("start", 0))
+        end = float(request.query["end"]) if "end" in request.query else None
+    except ValueError:
+        raise aiohttp.web.HTTPBadRequest(text="start and end must be UNIX times")
+    return site, device_key, field, start, end
+
+
+# Rows of a device field, ?resolution=raw (the default) gives [time, value] rows, 5m and 1h give
+# [time, min, max, avg, count] rows.
+async def api_history_handler(request):
+    import aiohttp.web
+    site, device_key, field, start, end = api_history_request(request)
+    resolution = request.query.get("resolution", "raw")
+    if resolution not in HistorySeries.RESOLUTIONS:
+        raise aiohttp.web.HTTPBadRequest(text=f"resolution must be one of {', '.join(HistorySeries.RESOLUTIONS)}")
+    rows = history_query(site, device_key, field, start, end, resolution)
+    METRICS.inc("sunpower_api_requests_total", status="200")
+    return aiohttp.web.json_response({ "device_key": device_key, "field": field, "resolution": resolution, "rows": [list(row) for row in rows] })
+
+
+# Min, max, avg and number of samples of a device field, null when nothing was recorded in the range.
+async def api_history_aggregate_handler(request):
+    import aiohttp.web
+    site, device_key, field, start, end = api_history_request(request)
+    aggregate = history_aggregate(site, device_key, field, start, end)
+    METRICS.inc("sunpower_api_requests_total", status="200")
+    return aiohttp.web.json_response({ "device_key": device_key, "field": field, "aggregate": aggregate })
+
+
+async def api_start_server():
+    import aiohttp.web
+    app = aiohttp.web.Application()
+    for prefix in ("", "/{site}"):
+        app.router.add_get(f"{prefix}/data", api_site_handler)
+        app.router.add_get(f"{prefix}/data/{{device_key}}", api_device_handler)
+        app.router.add_get(f"{prefix}/stream", api_stream_handler)
+        if HISTORY_ENABLED:
+            app.router.add_get(f"{prefix}/history/{{device_key}}/{{field}}", api_history_handler)
+            app.router.add_get(f"{prefix}/history/{{device_key}}/{{field}}/aggregate", api_history_aggregate_handler)
+    runner = aiohttp.web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await aiohttp.web.TCPSite(runner, API_HOST, API_PORT).start()
+    return runner
+
+
+# Append-only file of raw samples written by the record mode and read back by replay. Every record holds the kind,
+# the sample time, the site name and the zlib compressed payload: the DeviceList body for PVS records (empty when
+# the body did not change since the previous sample) and the raw (start, values) register blocks for ESS records.
+# A record cut short by a crash fails its checksum and is truncated when the file is opened for appending again.
+class Capture:
+    MAGIC = b"SPMQCAP1"
+    RECORD = struct.Struct("<BdHII")  # kind, sample time, site name length, payload length, crc
+    BLOCK = struct.Struct("<HH")  # start, count
+    PVS = 1
+    ESS = 2
+
+    def __init__(self, path):
+        self.file = open(path, "ab")
+        if self.file.tell() < len(self.MAGIC):
+            self.file.truncate(0)
+            self.file.write(self.MAGIC)
+        else:
+            end = len(self.MAGIC)
+            for end, _, _, _, _ in self.read(path):
+                pass
+            if end < self.file.tell():
+                print(f"Capture dropped {self.file.tell() - end} bytes of an incomplete record")
+                self.file.truncate(end)
+
+    # Yields (end position, kind, sample time, site name, compressed payload) for every valid record.
+    @classmethod
+    def read(cls, path):
+        with open(path, "rb") as file:
+            if file.read(len(cls.MAGIC)) != cls.MAGIC:
+                raise ValueError(f"{path} is not a capture file")
+            while True:
+                header = file.read(cls.RECORD.size)
+                if len(header) < cls.RECORD.size:
+                    return
+                kind, sample_time, name_length, payload_length, crc = cls.RECORD.unpack(header)
+                data = file.read(name_length + payload_length)
+                if len(data) < name_length + payload_length or zlib.crc32(data) != crc:
+                    return
+                yield file.tell(), kind, sample_time, data[:name_length].decode(), data[name_length:]
+
+    def append(self, kind, site, sample_time, payload):
+        name = site.name.encode()
+        payload = zlib.compress(payload) if len(payload) > 0 else b""
+        self.file.write(self.RECORD.pack(kind, sample_time, len(name), len(payload), zlib.crc32(name + payload)) + name + payload)
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+    @classmethod
+    def pack_blocks(cls, blocks):
+        return b"".join(cls.BLOCK.pack(start, len(values)) + struct.pack(f"<{len(values)}H", *values) for start, values in blocks)
+
+    @classmethod
+    def unpack_blocks(cls, payload):
+        blocks = []
+        position = 0
+        while position < len(payload):
+            start, count = cls.BLOCK.unpack_from(payload, position)
+            position += cls.BLOCK.size
+            blocks.append((start, list(struct.unpack_from(f"<{count}H", payload, position))))
+            position += 2 * count
+        return blocks
+
+
+CAPTURE = None
+
+
+# Runs step every period seconds (period may be a function so the rate can adapt). Ticks missed because a step
+# overran are skipped instead of being run back to back. A step that raises is retried after an exponential backoff
+# with jitter, exceptions never escape so one failing source cannot stop the others. wake() runs the step right away
+# and restarts the period from there.
+class Scheduler:
+    def __init__(self, name, period, step, backoff_min=SCHEDULER_BACKOFF_MIN, backoff_max=SCHEDULER_BACKOFF_MAX, jitter=SCHEDULER_JITTER):
+        self.name = name
+        self.period = period
+        self.step = step
+        self.backoff_min = backoff_min
+        self.backoff_max = backoff_max
+        self.jitter = jitter
+        self.failures = 0
+        self.missed = 0
+        self.lag = 0
+        self.wakeup = None
+
+    def current_period(self):
+        return self.period() if callable(self.period) else self.period
+
+    def wake(self):
+        if self.wakeup is not None:
+            self.wakeup.set()
+
+    # Sleeps until target_time or until woken, returns the time the next step is due.
+    async def sleep(self, target_time):
+        try:
+            await asyncio.wait_for(self.wakeup.wait(), max(target_time - time.time(), 0))
+            return time.time()
+        except asyncio.TimeoutError:
+            return target_time
+
+    async def run(self):
+        self.wakeup = asyncio.Event()
+        target_time = time.time()
+        while True:
+            self.wakeup.clear()
+            self.lag = time.time() - target_time
+            METRICS.set("sunpower_scheduler_lag_seconds", self.lag, task=self.name)
+            try:
+                await self.step()
+                self.failures = 0
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.failures += 1
+                METRICS.inc("sunpower_scheduler_failures_total", task=self.name)
+                delay = min(self.backoff_min * 2 ** (self.failures - 1), self.backoff_max)
+                delay *= 1 + random.uniform(-self.jitter, self.jitter)
+                print(f"{self.name} failed ({e!r}), retrying in {delay:0.1f}s")
+                target_time = await self.sleep(time.time() + delay)
+                continue
+            period = self.current_period()
+            target_time += period
+            now = time.time()
+            if target_time < now:
+                missed = math.ceil((now - target_time) / period)
+                self.missed += missed
+                METRICS.inc("sunpower_scheduler_missed_ticks_total", missed, task=self.name)
+                target_time += missed * period
+            target_time = await self.sleep(target_time)
+
+
+SITES = [Site(name) for name in SITE_NAMES] if len(SITE_NAMES) > 0 else [Site()]
+
+
+async def main(capture_path=None):
+    global MQTT_BUFFER
+    global MQTT_SCHEDULER
+    global CAPTURE
+    global EXPORT_SINKS
+    if capture_path is not None:
+        CAPTURE = Capture(capture_path)
+    if BUFFER_ENABLED:
+        MQTT_BUFFER = MessageBuffer(BUFFER_PATH, BUFFER_SIZE)
+        METRICS.collectors.append(metrics_collect_buffer)
+    if METRICS_ENABLED:
+        await metrics_start_server()
+    if API_ENABLED:
+        await api_start_server()
+    MQTT_SCHEDULER = Scheduler("mqtt", MQTT_PUBLISH_PERIOD, mqtt_publish)
+    schedulers = [MQTT_SCHEDULER]
+    for site in SITES:
+        schedulers.append(Scheduler(site.task_name("pvs"), site.pvs_sample_period, functools.partial(pvs_sample, site)))
+        if site.ess_enabled:
+            schedulers.append(Scheduler(site.task_name("ess"), functools.partial(ess_sample_period, site), functools.partial(ess_sample, site)))
+    if MQTT_ENABLED and MQTT_BUFFER is not None:
+        schedulers.append(Scheduler("buffer", BUFFER_DRAIN_PERIOD, mqtt_drain_buffer))
+    EXPORT_SINKS = export_create_sinks(MQTT_ENABLED)
+    await asyncio.gather(*(scheduler.run() for scheduler in schedulers), *(sink.run() for sink in EXPORT_SINKS))
+
+
+# Replays a capture written by the record mode through the same processing, merge and publish steps as live
+# sampling, as fast as possible. The recorded sample times stand in for the clock so availability, heartbeats and
+# the history follow the original run. Publishing waits for the MQTT connection instead of buffering so nothing
+# of a backfill is dropped. The replay has its own status topic (<topic_prefix>/status/replay) and does not send
+# the Home Assistant configuration, which stays pointed at the status topic of the running service, and does not
+# serve the API. The export sinks are flushed whenever a batch is full instead of dropping points. Nothing is published
+# when MQTT is disabled, the replay gives up when the MQTT server cannot be reached for connect_timeout seconds.
+# Returns the exit status.
+async def replay(path, publish=True, connect_timeout=60):
+    global MQTT_PUBLISHER
+    global MQTT_STATUS_TOPIC
+    global HOMEASSISTANT_SEND_CONFIG
+    global API_ENABLED
+    global EXPORT_SINKS
+    MQTT_STATUS_TOPIC = f"{MQTT_TOPIC_PREFIX}/status/replay"
+    HOMEASSISTANT_SEND_CONFIG = False
+    API_ENABLED = False
+    publish = publish and MQTT_ENABLED
+    if publish:
+        MQTT_PUBLISHER = MqttPublisher(MQTT_HOST, MQTT_PORT, MQTT_USERNAME, MQTT_PASSWORD)
+        MQTT_PUBLISHER.start()
+    EXPORT_SINKS = export_create_sinks(publish)
+
+    async def wait_connected():
+        deadline = time.time() + connect_timeout
+        while not MQTT_PUBLISHER.connected:
+            if time.time() >= deadline:
+                return False
+            await asyncio.sleep(0.1)
+        return True
+
+    sites = { site.name: site for site in SITES }
+    counts = { Capture.PVS: 0, Capture.ESS: 0 }
+    skipped = 0
+    published = METRICS.counters.get(("sunpower_mqtt_messages_total", ()), 0)
+    start = time.perf_counter()
+    for _, kind, sample_time, site_name, payload in Capture.read(path):
+        site = sites.get(site_name)
+        if site is None or kind not in counts:
+            skipped += 1
+            continue
+        payload = zlib.decompress(payload) if len(payload) > 0 else b""
+        if kind == Capture.PVS and len(payload) == 0:
+            pvs_apply_sample(site, [], site.pvs_last_digest, sample_time)
+        elif kind == Capture.PVS:
+            parser = PvsDeviceListParser()
+            devices = parser.feed(payload) + parser.feed(b"", final=True)
+            pvs_apply_sample(site, devices, hashlib.blake2b(payload, digest_size=16).digest(), sample_time)
+        else:
+            ess_apply_sample(site, ess_decode_blocks(site, Capture.unpack_blocks(payload)), sample_time)
+        counts[kind] += 1
+        if publish:
+            if not await wait_connected():
+                print(f"MQTT server {MQTT_HOST}:{MQTT_PORT} could not be reached within {connect_timeout}s, stopping the replay after {counts[Capture.PVS] + counts[Capture.ESS]} samples")
+                MQTT_PUBLISHER.stop()
+                return 1
+            await mqtt_publish(sample_time)
+        for sink in EXPORT_SINKS:
+            if len(sink.queue) >= sink.batch_size:
+                await sink.flush()
+    for sink in EXPORT_SINKS:
+        await sink.flush()
+    if MQTT_PUBLISHER is not None:
+        while MQTT_PUBLISHER.connected and len(MQTT_PUBLISHER.inflight) > 0:
+            await asyncio.sleep(0.01)
+    elapsed = time.perf_counter() - start
+    if MQTT_PUBLISHER is not None:
+        MQTT_PUBLISHER.stop()
+    samples = counts[Capture.PVS] + counts[Capture.ESS]
+    published = METRICS.counters.get(("sunpower_mqtt_messages_total", ()), 0) - published
+    print(f"Replayed {samples} samples ({counts[Capture.PVS]} PVS, {counts[Capture.ESS]} ESS) in {elapsed:0.3f}s, {samples / elapsed if elapsed > 0 else 0:0.1f} samples/s, {published} messages published")
+    if skipped > 0:
+        print(f"Skipped {skipped} records of unknown sites")
+    return 0
+
+
+# Runs the named sites in a worker process. Each worker has its own MQTT connection and therefore its own status
+# topic (<topic_prefix>/status/<index>), buffer file (<path>.<index>), capture file (<path>.<index>), metrics and
+# API ports (port + index) and export files (<path>.<index> and <directory>/<index>).
+def site_worker(index, names, capture_path):
+    global SITES
+    global MQTT_STATUS_TOPIC
+    global BUFFER_PATH
+    global METRICS_PORT
+    global API_PORT
+    global EXPORT_LINE_PROTOCOL_PATH
+    global EXPORT_CSV_DIRECTORY
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    SITES = [site for site in SITES if site.name in names]
+    MQTT_STATUS_TOPIC = f"{MQTT_TOPIC_PREFIX}/status/{index}"
+    BUFFER_PATH = f"{BUFFER_PATH}.{index}"
+    METRICS_PORT += index
+    API_PORT += index
+    EXPORT_LINE_PROTOCOL_PATH = f"{EXPORT_LINE_PROTOCOL_PATH}.{index}"
+    EXPORT_CSV_DIRECTORY = os.path.join(EXPORT_CSV_DIRECTORY, str(index))
+    asyncio.run(main(f"{capture_path}.{index}" if capture_path is not None else None))
+
+
+# Splits the sites across SITE_WORKERS worker processes and restarts a worker whenever it exits. The workers are
+# stopped along with this process.
+def run_workers(capture_path=None):
+    workers = min(SITE_WORKERS, len(SITES))
+    shards = [[site.name for site in SITES[index::workers]] for index in range(workers)]
+    processes = [None] * workers
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        while True:
+            for index, names in enumerate(shards):
+                if processes[index] is None or not processes[index].is_alive():
+                    if processes[index] is not None:
+                        print(f"worker {index} exited with {processes[index].exitcode}, restarting")
+                    processes[index] = multiprocessing.Process(target=site_worker, args=(index, names, capture_path), name=f"sunpower_mqtt-{index}")
+                    processes[index].start()
+            multiprocessing.connection.wait([process.sentinel for process in processes])
+            time.sleep(SCHEDULER_BACKOFF_MIN)
+    finally:
+        for process in processes:
+            if process is not None and process.is_alive():
+                process.terminate()
+                process.join()
+
+
+# Command line entry point, the module itself can be imported without side effects beyond reading the config.
+def run(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description="Publishes SunPower PVS and ESS data to MQTT")
+    modes = parser.add_subparsers(dest="mode")
+    record_parser = modes.add_parser("record", help="run as usual and append every raw PVS and ESS sample to a capture file")
+    record_parser.add_argument("capture", help="capture file to append to")
+    replay_parser = modes.add_parser("replay", help="process and publish a capture as fast as possible")
+    replay_parser.add_argument("capture", help="capture file written by record")
+    replay_parser.add_argument("--no-publish", action="store_true", help="only process and merge the samples")
+    replay_parser.add_argument("--connect-timeout", type=float, default=60, help="seconds to wait for the MQTT server before giving up")
+    args = parser.parse_args(argv)
+    capture_path = args.capture if args.mode == "record" else None
+    if args.mode == "replay":
+        sys.exit(asyncio.run(replay(args.capture, not args.no_publish, args.connect_timeout)))
+    elif SITE_WORKERS > 1 and len(SITES) > 1:
+        run_workers(capture_path)
+    else:
+        asyncio.run(main(capture_path))
+
 
+if __name__ == "__main__":
+    run()
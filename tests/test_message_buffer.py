@@ -0,0 +1,125 @@
+import asyncio
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sunpower_mqtt import MessageBuffer
+
+# Every test record is "t" plus a 4 character payload: the record header, the topic, its separator and the payload.
+RECORD_SIZE = MessageBuffer.RECORD.size + 6
+
+
+def make_buffer(tmp_path, records, name="buffer.bin"):
+    return MessageBuffer(str(tmp_path / name), MessageBuffer.HEADER_SIZE + RECORD_SIZE * records)
+
+
+def append(buffer, numbers):
+    for number in numbers:
+        buffer.append(number, "t", f"{number:04d}")
+
+
+def payloads(buffer):
+    return [int(payload) for _, _, payload in buffer.peek(buffer.count)]
+
+
+def test_records_are_read_and_consumed_in_order(tmp_path):
+    buffer = make_buffer(tmp_path, 10)
+    append(buffer, range(5))
+    assert buffer.count == 5
+    assert buffer.peek(2) == [(0.0, "t", b"0000"), (1.0, "t", b"0001")]
+    buffer.consume(buffer.first, 2)
+    assert payloads(buffer) == [2, 3, 4]
+    buffer.consume(buffer.first, 3)
+    assert buffer.count == 0
+    assert buffer.stats() == { "messages": 0, "bytes": 0, "dropped": 0 }
+
+
+def test_full_buffer_drops_the_oldest_records(tmp_path):
+    buffer = make_buffer(tmp_path, 10)
+    append(buffer, range(25))
+    assert payloads(buffer) == list(range(25 - buffer.count, 25))
+    assert buffer.dropped == 25 - buffer.count
+    assert buffer.used <= buffer.capacity
+
+
+def test_records_stay_in_order_across_the_wrap(tmp_path):
+    buffer = make_buffer(tmp_path, 10)
+    append(buffer, range(8))
+    buffer.consume(buffer.first, 6)
+    # The next records no longer fit at the end of the ring and continue at its start.
+    append(buffer, range(8, 14))
+    assert buffer.head < buffer.tail
+    assert payloads(buffer) == list(range(6, 14))
+    assert buffer.dropped == 0
+
+
+def test_reopened_buffer_keeps_its_records(tmp_path):
+    buffer = make_buffer(tmp_path, 10)
+    append(buffer, range(8))
+    buffer.consume(buffer.first, 6)
+    append(buffer, range(8, 14))
+    buffer.close()
+    buffer = make_buffer(tmp_path, 10)
+    assert payloads(buffer) == list(range(6, 14))
+
+
+def test_recovery_drops_a_corrupt_record(tmp_path):
+    buffer = make_buffer(tmp_path, 10)
+    append(buffer, range(3))
+    # Damage the payload of the newest record, as if the crash happened while it was written.
+    buffer.mmap[buffer.HEADER_SIZE + buffer.head - 1] ^= 0xFF
+    buffer.close()
+    buffer = make_buffer(tmp_path, 10)
+    assert payloads(buffer) == [0, 1]
+    append(buffer, [3])
+    assert payloads(buffer) == [0, 1, 3]
+
+
+def test_recovery_falls_back_to_the_older_header(tmp_path):
+    buffer = make_buffer(tmp_path, 10)
+    append(buffer, range(3))
+    # The newest header is torn, the other one still describes the first two records.
+    buffer.mmap[(buffer.sequence % 2) * (buffer.HEADER_SIZE // 2)] ^= 0xFF
+    buffer.close()
+    buffer = make_buffer(tmp_path, 10)
+    assert payloads(buffer) == [0, 1]
+
+
+def test_consume_skips_records_dropped_while_draining(tmp_path):
+    buffer = make_buffer(tmp_path, 10)
+    append(buffer, range(10))
+    start = buffer.first
+    batch = buffer.peek(4)
+    # New records push the oldest out of the full buffer while the batch is being published.
+    append(buffer, range(10, 13))
+    buffer.consume(start, len(batch))
+    assert payloads(buffer) == list(range(4, 13))
+
+
+def test_resize_keeps_the_records(tmp_path):
+    buffer = make_buffer(tmp_path, 10)
+    append(buffer, range(6))
+    buffer.close()
+    buffer = make_buffer(tmp_path, 20)
+    assert buffer.capacity == RECORD_SIZE * 20
+    assert payloads(buffer) == list(range(6))
+    assert not os.path.exists(tmp_path / "buffer.bin.resize")
+
+
+def test_shrinking_keeps_the_newest_records(tmp_path):
+    buffer = make_buffer(tmp_path, 10)
+    append(buffer, range(10))
+    buffer.close()
+    buffer = make_buffer(tmp_path, 4)
+    assert payloads(buffer) == list(range(10 - buffer.count, 10))
+    assert buffer.count >= 3
+
+
+def test_flush_writes_the_records_to_the_file(tmp_path):
+    buffer = make_buffer(tmp_path, 10)
+    append(buffer, range(2))
+    asyncio.run(buffer.flush())
+    with open(tmp_path / "buffer.bin", "rb") as file:
+        data = file.read()
+    assert b"t\x000000" in data and b"t\x000001" in data